@@ -0,0 +1,83 @@
+"""Reports the memory used per graph node.
+
+Builds a graph of leaf nodes (settable, no inputs) and of calculated
+nodes that each read one leaf, and reports the bytes used per node by
+the current Node layout alongside the previous layout, which kept its
+state in an instance dictionary holding three booleans, three values
+and two eagerly allocated sets.
+
+Run from the top of the source tree:
+
+    python benchmarks/node_memory.py [count]
+
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import nodes
+from nodes.nodes import _graph
+
+class Instrument(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Price(self, i):
+        return float(i)
+
+    @nodes.graphMethod
+    def Value(self, i):
+        return self.Price(i) * 2
+
+class DictNode(object):
+    """The Node layout before it was compacted."""
+
+    def __init__(self, node):
+        self.graphObject = node.graphObject
+        self.graphMethod = node.graphMethod
+        self.args = node.args
+        self._outputs = set(node.outputs)
+        self._inputs = set(node.inputs)
+        self._isOverlaid = node.isOverlaid()
+        self._isSet = node.isSet()
+        self._isCalced = node.isCalced()
+        self._overlaidValue = None
+        self._setValue = None
+        self._calcedValue = None
+
+def nodeSize(node):
+    """Returns the bytes owned by a single node: the instance, its
+    dictionary (if any) and its edge containers.  Values, args and
+    the objects a node refers to are shared and not counted.
+
+    """
+    size = sys.getsizeof(node)
+    if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+    for name in ('_inputs', '_inputOrder', '_outputs'):
+        edges = getattr(node, name, None)
+        if edges is not None:
+            size += sys.getsizeof(edges)
+    return size
+
+def report(label, allNodes):
+    compact = sum(nodeSize(node) for node in allNodes)
+    legacy = sum(nodeSize(DictNode(node)) for node in allNodes)
+    print('%-12s %8d nodes  before: %6.1f bytes/node  after: %6.1f bytes/node  (%.0f%% saved)' % (
+            label,
+            len(allNodes),
+            float(legacy) / len(allNodes),
+            float(compact) / len(allNodes),
+            100.0 * (legacy - compact) / legacy,
+            ))
+
+def main(count=100000):
+    o = Instrument()
+    for i in range(count):
+        o.Value(i)
+    report('leaves', [o.Price.node(i) for i in range(count)])
+    report('calculated', [o.Value.node(i) for i in range(count)])
+    report('all', list(_graph.nodes.values()))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,2 +1,2 @@
 from .nodes import *
-
+from .persistence import *
@@ -1,34 +1,639 @@
 """nodes: An easy-to-use graph-oriented object model for Python.
 
 """
+import ast
 import collections
 import copy
+import gc
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
+import mmap
+import multiprocessing.pool
+import os
+import struct
+import textwrap
+import threading
 import types
+import weakref
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 Settable     = 0x1
 Serializable = 0x2
 Saved        = Settable | Serializable
 Overlayable  = 0x4
 
+# Node state bits, packed into Node._state.
+#
+_IsSet       = 0x2
+_IsCalced    = 0x4
+_IsStale     = 0x8     # A retained calced value that may be out of date.
+_IsDirty     = 0x10    # A retained calced value known to be out of date.
+_IsStatic    = 0x20    # All inputs are known statically, so they are kept.
+
+class _GraphLocal(threading.local):
+    """Graph state specific to the evaluating thread.
+
+    """
+    activeNode = None          # The active node during a computation.
+    activeGraphContext = None  # The active context.
+    pendingChanges = None      # Changes buffered by an open batch.
+    inWorker = False           # Evaluating on behalf of evaluateParallel.
+
+class _ReadWriteLock(object):
+    """Lets any number of threads evaluate the graph at once, while
+    a thread changing the graph has it to itself.
+
+    Readers only wait for a writer that holds the lock, not for one
+    waiting to acquire it, so a reader can always bring in others (to
+    evaluate inputs in parallel, say) without deadlocking.  The writing
+    thread may itself read, and may write reentrantly.
+
+    A reading thread (one inside a graph context, say) may also write,
+    once every other thread has stopped reading.  Two reading threads
+    can't both wait to write, as each would wait for the other, so the
+    second to try raises a RuntimeError instead.
+
+    The generation is odd while a thread holds the lock for writing and
+    moves on each time one starts or stops, so a reader that takes no
+    lock can tell whether a write overlapped it.
+
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._reads = {}        # The number of reads each reading thread holds, by ident.
+        self._writer = None     # The ident of the writing thread, if any.
+        self._writes = 0
+        self._upgrading = None  # The ident of a reading thread waiting to write, if any.
+        self._generation = 0
+
+    def acquireRead(self):
+        ident = get_ident()
+        with self._condition:
+            while self._writer is not None and self._writer != ident:
+                self._condition.wait()
+            self._readers += 1
+            self._reads[ident] = self._reads.get(ident, 0) + 1
+
+    def releaseRead(self):
+        ident = get_ident()
+        with self._condition:
+            self._readers -= 1
+            reads = self._reads[ident] - 1
+            if reads:
+                self._reads[ident] = reads
+            else:
+                del self._reads[ident]
+            if not self._readers or self._upgrading is not None:
+                self._condition.notify_all()
+
+    def acquireWrite(self):
+        ident = get_ident()
+        with self._condition:
+            if self._writer == ident:
+                self._writes += 1
+                return
+            reads = self._reads.get(ident, 0)
+            if reads:
+                if self._upgrading is not None:
+                    raise RuntimeError("Another thread reading the graph is waiting to change it.")
+                self._upgrading = ident
+            try:
+                while self._writer is not None or self._readers > reads:
+                    self._condition.wait()
+            finally:
+                if reads:
+                    self._upgrading = None
+            self._writer = ident
+            self._writes = 1
+            self._generation += 1
+
+    def releaseWrite(self):
+        with self._condition:
+            self._writes -= 1
+            if not self._writes:
+                self._generation += 1
+                self._writer = None
+                self._condition.notify_all()
+
+class _Computation(object):
+    """Marks a node as being calculated by a thread, so that other
+    threads wanting its value wait for it rather than calculating it
+    themselves.
+
+    """
+    __slots__ = ('thread', 'waiters')
+
+    def __init__(self):
+        self.thread = get_ident()
+        self.waiters = 0
+
 class Graph(object):
     """The core graph plumbing; essentially the controller and
     global runtime state.
 
+    The graph may be used from multiple threads.  Each thread has its
+    own active node and context, any number of threads may evaluate
+    nodes at once (a node wanted by several threads is calculated once,
+    by the first of them), and changes to the graph wait for evaluations
+    in progress, and for graph contexts active in other threads, to
+    finish and hold off new ones while they are applied.
+
     """
     def __init__(self):
-        self.nodes = {}
-        self.activeNode = None          # The active node during a computation.
-        self.activeGraphContext = None  # The active context.
+        # Nodes are owned by the GraphInstanceMethods of their objects
+        # and by the nodes that depend on them; the graph only indexes
+        # them, so it never keeps a node (or its object) alive.
+        #
+        self.nodes = weakref.WeakValueDictionary()
+        self.earlyCutoff = False        # Verify stale nodes before recalculating them.
+        self.maxThreads = None          # The size of evaluateParallel's pool; None for the CPU count.
+        self._local = _GraphLocal()
+        self._lock = _ReadWriteLock()
+        self._computations = {}             # Nodes being calculated, by node.
+        self._computed = threading.Condition(threading.Lock())
+        self._contexts = weakref.WeakSet()  # Live contexts, which may refer to nodes.
+        self._contextLock = threading.RLock()   # Held while contexts are entered and exited.
+        self._observed = set()              # Nodes kept up to date by stabilize().
+        self._deferredInvalidations = None  # Nodes whose outputs await invalidation.
+        self._listeners = []                # Called with each node whose set value changes.
+        self._pool = None                   # The thread pool shared by evaluateParallel calls.
+        self._poolKey = None                # The process and size the pool was created for.
+        self._poolLock = threading.Lock()
+
+        # Once a checkpoint is taken, changes to the set values of Saved
+        # nodes are versioned, and the latest version of each changed node
+        # is kept, in version order, until the change is trimmed.
+        #
+        self._savedVersions = itertools.count(1)
+        self._savedVersion = 0
+        self._savedChanges = None       # Versions by node, once tracked.
+        self._trimmedVersion = 0
+        self._snapshot = None               # The _Snapshot restored, if any.
+
+        # The revision identifies the state of the graph's sets: any
+        # change to them takes a new one, which discards the values
+        # calculated within contexts.
+        #
+        self._revisions = itertools.count(1)
+        self._revision = 0
+
+    @property
+    def activeNode(self):
+        """The node being calculated by the current thread, if any.
+
+        """
+        return self._local.activeNode
+
+    @activeNode.setter
+    def activeNode(self, node):
+        self._local.activeNode = node
+
+    @property
+    def activeGraphContext(self):
+        """The graph context active in the current thread, if any.
+
+        """
+        return self._local.activeGraphContext
+
+    @activeGraphContext.setter
+    def activeGraphContext(self, graphContext):
+        self._local.activeGraphContext = graphContext
 
     def lookupNode(self, graphInstanceMethod, args, create=True):
         """Returns the Node underlying the given object and its method
         as called with the specified arguments.
 
         """
-        key = (graphInstanceMethod.graphObject, graphInstanceMethod.name) + args
-        if key not in self.nodes and create:
-            self.nodes[key] = Node(graphInstanceMethod.graphObject, graphInstanceMethod.graphMethod, args=args)
-        return self.nodes.get(key)
+        node = graphInstanceMethod._nodes.get(args)
+        if node is not None:
+            return node
+        key = (id(graphInstanceMethod.graphObject), graphInstanceMethod.name) + args
+        node = self.nodes.get(key)
+        if node is None:
+            if not create:
+                return None
+            node = self.nodes[key] = Node(graphInstanceMethod.graphObject, graphInstanceMethod.graphMethod, args=args)
+            graphInstanceMethod._nodes[args] = node
+            if graphInstanceMethod._static is not None:
+                self._wireStaticInputs(node)
+            if self._snapshot is not None:
+                self._snapshot.materialize(node)
+            return node
+        graphInstanceMethod._nodes[args] = node
+        return node
+
+    def _wireStaticInputs(self, node):
+        """Adds the edges from a new node to the inputs its method is
+        known to read, creating (and wiring) those that don't exist yet.
+
+        """
+        worklist = [node]
+        while worklist:
+            node = worklist.pop()
+            graphObject = node.graphObject
+            static = getattr(graphObject, node.graphMethod.name)._static
+            for name, args in static.inputs:
+                graphInstanceMethod = getattr(graphObject, name)
+                inputNode = graphInstanceMethod._nodes.get(args)
+                if inputNode is None:
+                    key = (id(graphObject), name) + args
+                    inputNode = self.nodes.get(key)
+                    if inputNode is None:
+                        inputNode = self.nodes[key] = Node(graphObject, graphInstanceMethod.graphMethod, args=args)
+                        if graphInstanceMethod._static is not None:
+                            worklist.append(inputNode)
+                    graphInstanceMethod._nodes[args] = inputNode
+                node.addInput(inputNode)
+                inputNode.addOutput(node)
+            if static.complete:
+                node._state |= _IsStatic
+
+    def collect(self):
+        """Sweeps orphaned argument-specific nodes, such as those left
+        behind by one-off calls like o.F(v), and returns the number of
+        nodes removed.
+
+        A node is an orphan if it was called with arguments, nothing
+        depends on it, it is neither set nor overlaid and no graph
+        context refers to it.  Removing a node discards its memoized
+        value; calling it again simply creates a new node.
+
+        Nodes without arguments are never swept.  They live exactly as
+        long as their GraphObject, or as long as another live node
+        depends on them.
+
+        """
+        if self.isComputing():
+            raise RuntimeError("You cannot collect nodes during graph evaluation.")
+        self._lock.acquireWrite()
+        try:
+            return self._collect()
+        finally:
+            self._lock.releaseWrite()
+
+    def _collect(self):
+        """Sweeps orphaned nodes; see collect().
+
+        """
+        referenced = set()
+        for graphContext in self._contexts:
+            referenced.update(graphContext._overlays)
+            if graphContext._active:
+                referenced.update(graphContext._layerOverlays)
+        removed = set()
+        candidates = list(self.nodes.values())
+        while candidates:
+            node = candidates.pop()
+            if not node.args or node in removed or node in referenced:
+                continue
+            if node._state & _IsSet:
+                continue
+            if node._outputs:
+                liveOutputs = set()
+                for ref in node._outputs:
+                    output = ref()
+                    if output is not None and output not in removed:
+                        liveOutputs.add(ref)
+                node._outputs = liveOutputs or None
+                if liveOutputs:
+                    continue
+            removed.add(node)
+            graphInstanceMethod = getattr(node.graphObject, node.graphMethod.name)
+            graphInstanceMethod._nodes.pop(node.args, None)
+            self.nodes.pop((id(node.graphObject), node.graphMethod.name) + node.args, None)
+            candidates.extend(node.inputs)
+
+        # Values calculated within contexts may refer to swept nodes.
+        #
+        if removed:
+            for graphContext in self._contexts:
+                if graphContext._values is not None:
+                    graphContext._clearValues()
+        return len(removed)
+
+    def observe(self, node):
+        """Marks a node as observed, so that stabilize() keeps it (and
+        everything it depends on) up to date.
+
+        An observed node is held by the graph, and so is its
+        GraphObject, until it is unobserved.
+
+        """
+        self._observed.add(node)
+
+    def unobserve(self, node):
+        """Stops observing a node, or does nothing if the node is not
+        observed.
+
+        """
+        self._observed.discard(node)
+
+    def addListener(self, listener):
+        """Registers a callable to be called with each node whose set
+        value changes, just after the change (so when a batch is
+        applied, not when the change is made within it).  Overlays,
+        being temporary, are not reported.
+
+        The graph holds the listener until it is removed.
+
+        """
+        self._listeners.append(listener)
+
+    def removeListener(self, listener):
+        """Stops calling a listener, or does nothing if the listener
+        was not registered.
+
+        """
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _setChanged(self, node):
+        """Records a change to the node's set value: its version, if it
+        is saved, and its listeners are told.
+
+        """
+        if self._savedChanges is not None and node.graphMethod.flags & Saved == Saved:
+            self._savedVersion = next(self._savedVersions)
+            self._savedChanges.pop(node, None)
+            self._savedChanges[node] = self._savedVersion
+        for listener in list(self._listeners):
+            listener(node)
+
+    def checkpoint(self):
+        """Returns a checkpoint: the version of the latest change to the
+        set value of a Saved node, for changesSince().
+
+        Changes are only tracked from the first checkpoint on.
+
+        """
+        if self._savedChanges is None:
+            self._lock.acquireWrite()
+            try:
+                if self._savedChanges is None:
+                    self._savedChanges = collections.OrderedDict()
+            finally:
+                self._lock.releaseWrite()
+        return self._savedVersion
+
+    def changesSince(self, checkpoint):
+        """Generates a SavedChange for each Saved node whose set value
+        has changed since the checkpoint, in the order of the nodes'
+        latest changes, in time proportional to the number of changes.
+
+        The graph holds each changed node (and its object) until the
+        change is trimmed; see trimChanges().
+
+        """
+        if self.isComputing():
+            raise RuntimeError("You cannot read changes during graph evaluation.")
+        self._lock.acquireWrite()
+        try:
+            if self._savedChanges is None:
+                raise ValueError("Changes are only tracked from the first checkpoint on.")
+            if checkpoint < self._trimmedVersion:
+                raise ValueError("Changes up to %d have been trimmed." % self._trimmedVersion)
+            changes = []
+            for node in reversed(self._savedChanges):
+                version = self._savedChanges[node]
+                if version <= checkpoint:
+                    break
+                changes.append(SavedChange(version, node.graphObject, node.graphMethod.name, node.args,
+                                           node.isSet(), node._setValue))
+        finally:
+            self._lock.releaseWrite()
+        for change in reversed(changes):
+            yield change
+
+    def trimChanges(self, checkpoint):
+        """Forgets the changes made up to the checkpoint, which can then
+        no longer be passed to changesSince(), and returns the number of
+        changes forgotten.
+
+        """
+        if self.isComputing():
+            raise RuntimeError("You cannot trim changes during graph evaluation.")
+        self._lock.acquireWrite()
+        try:
+            trimmed = 0
+            for node, version in list((self._savedChanges or {}).items()):
+                if version > checkpoint:
+                    break
+                del self._savedChanges[node]
+                trimmed += 1
+            self._trimmedVersion = max(self._trimmedVersion, checkpoint)
+            return trimmed
+        finally:
+            self._lock.releaseWrite()
+
+    def savedVersion(self, node):
+        """Returns the version of the latest change to the set value of
+        a Saved node that hasn't been trimmed, or 0.
+
+        """
+        return (self._savedChanges or {}).get(node, 0)
+
+    def stabilize(self):
+        """Brings every observed node up to date and returns the number
+        of nodes that were brought up to date.
+
+        Every invalid node an observed node depends on (as of its last
+        evaluation) is brought up to date exactly once, in order of
+        increasing height, so that each node is recalculated only after
+        all of its inputs are.  A node whose inputs change during its
+        recalculation simply pulls any new, invalid input as usual.
+
+        """
+        if self.isComputing():
+            raise RuntimeError("You cannot stabilize the graph during graph evaluation.")
+        heap = []
+        visited = set()
+        worklist = [node for node in self._observed if not node.isValid()]
+        while worklist:
+            node = worklist.pop()
+            if node in visited:
+                continue
+            visited.add(node)
+            heap.append((node._height, len(heap), node))
+            worklist.extend(inputNode for inputNode in node.inputs if not inputNode.isValid())
+        heapq.heapify(heap)
+        count = 0
+        while heap:
+            node = heapq.heappop(heap)[2]
+            if not node.isValid():
+                self._evaluate(node)
+                count += 1
+        return count
+
+    def evaluateParallel(self, nodes, executor=None):
+        """Returns a list of the values of the given nodes, evaluating
+        them concurrently.
+
+        executor is optional and if provided must be an object with a
+        map(function, iterable) method that runs the function on worker
+        threads, such as a concurrent.futures.ThreadPoolExecutor or a
+        multiprocessing.pool.ThreadPool.  By default the nodes are
+        evaluated on a thread pool shared by all calls, of maxThreads
+        threads (or one per CPU).
+
+        Each node is evaluated on a worker in the active graph context,
+        and its own dependencies are discovered as usual.  If called
+        while calculating a node, the nodes become its inputs just as
+        if it had read them one at a time.
+
+        Calls made by the workers themselves, from the nodes they
+        calculate, evaluate their nodes one at a time on the worker, so
+        the number of threads stays bounded and a worker never waits
+        for others from the pool it occupies.  Likewise a graph context
+        is active in a single thread, so from within a context the
+        nodes are evaluated on the calling thread.
+
+        """
+        nodes = list(nodes)
+        local = self._local
+        outputNode = local.activeNode
+        graphContext = local.activeGraphContext
+        if len(nodes) < 2 or local.inWorker or graphContext is not None or self._lock._writer == get_ident():
+            return [self.getValue(node) for node in nodes]
+
+        def evaluate(node):
+            local = self._local
+            previousGraphContext, local.activeGraphContext = local.activeGraphContext, graphContext
+            inWorker, local.inWorker = local.inWorker, True
+            try:
+                return self._evaluate(node)
+            finally:
+                local.inWorker = inWorker
+                local.activeGraphContext = previousGraphContext
+
+        if executor is None:
+            executor = self._threadPool()
+        values = list(executor.map(evaluate, nodes))
+        if outputNode is not None:
+            for node in nodes:
+                if outputNode._inputs is None or node not in outputNode._inputs:
+                    outputNode.addInput(node)
+                    node.addOutput(outputNode)
+        return values
+
+    def _threadPool(self):
+        """Returns the thread pool shared by evaluateParallel calls,
+        creating it as needed.
+
+        A pool's threads don't survive a fork (see evaluateScenarios),
+        and changing maxThreads resizes it, so the pool is created anew
+        in either case.
+
+        """
+        key = (os.getpid(), self.maxThreads or multiprocessing.cpu_count())
+        with self._poolLock:
+            if self._poolKey != key:
+                if self._pool is not None and self._poolKey[0] == key[0]:
+                    self._pool.close()
+                self._pool = multiprocessing.pool.ThreadPool(key[1])
+                self._poolKey = key
+            return self._pool
+
+    def sweep(self, targetNode, inputNode, values, asArray=False):
+        """Returns a list of the target node's values with the input
+        node overlaid with each of the given values in turn.
+
+        Either node may be given as a graph instance method that takes
+        no arguments.  The sweep runs in a graph context of its own, on
+        top of any that is active, and leaves the graph as it found it.
+        The nodes the input doesn't affect are evaluated once, for the
+        first value, and for the rest only the nodes that depend on the
+        input are recalculated.
+
+        If asArray is True the values are returned as a NumPy array
+        (or, if NumPy isn't installed, a list).
+
+        """
+        targetNode, inputNode = _asNode(targetNode), _asNode(inputNode)
+        results = []
+        with GraphContext(graph=self) as graphContext:
+            for value in values:
+                graphContext.overlayValue(inputNode, value)
+                results.append(self.getValue(targetNode))
+        if asArray:
+            return _asArray(results)
+        return results
+
+    def compile(self, rootNode, leaves=None):
+        """Returns a CompiledGraph: a function of the values of the
+        leaves that returns the root's value as if the leaves were
+        overlaid with them, without the overhead of evaluating nodes.
+
+        The root and leaves may be nodes or graph instance methods that
+        take no arguments.  By default the leaves are the settable nodes
+        without inputs beneath the root, in the order of the compiled
+        function's leaves attribute.
+
+        Raises a RuntimeError if a node between the leaves and the root
+        can't be compiled, in which case it may be possible to give that
+        node, or nodes beneath it, as leaves instead.
+
+        """
+        if leaves is not None:
+            leaves = [_asNode(leaf) for leaf in leaves]
+        return CompiledGraph(self, _asNode(rootNode), leaves)
+
+    def snapshot(self, path, store):
+        """Writes the state of the graph's nodes to a file, from which
+        restore() can warm start a later process, and returns the number
+        of nodes written.
+
+        Nodes are identified by the ids of their objects in the store,
+        so only the nodes of objects added to or loaded from it are
+        written, along with their set values, the calced values that are
+        up to date (and whose inputs are written as well) and the edges
+        to those inputs.  Values must be picklable, and may only refer to
+        GraphObjects in the store.  Overlays belong to graph contexts,
+        which don't outlive the process, and are not written.
+
+        """
+        if self.isComputing():
+            raise RuntimeError("You cannot snapshot the graph during graph evaluation.")
+        self._lock.acquireWrite()
+        try:
+            return _writeSnapshot(self, path, store)
+        finally:
+            self._lock.releaseWrite()
+
+    def restore(self, path, store=None):
+        """Restores a snapshot written by snapshot() with the same store,
+        replacing any restored before, or, if path is None, discards the
+        snapshot restored.
+
+        The file is memory-mapped and nothing is read from it up front:
+        each node is seeded from it when it is first looked up, with
+        its objects loaded from the store as needed.  A calced value is
+        only restored if the values of its inputs are those they had
+        when the snapshot was taken.
+
+        """
+        if self.isComputing():
+            raise RuntimeError("You cannot restore a snapshot during graph evaluation.")
+        snapshot = _Snapshot(self, path, store) if path is not None else None
+        self._lock.acquireWrite()
+        try:
+            previous, self._snapshot = self._snapshot, snapshot
+        finally:
+            self._lock.releaseWrite()
+        if previous is not None:
+            previous.close()
 
     def isComputing(self):
         """Returns True if the graph is currently computing a value,
@@ -39,25 +644,166 @@ class Graph(object):
 
         """
         # The test is simple at the moment: if a node is active,
-        # we're computing.
+        # or being calculated within a context, we're computing.
         #
-        return self.activeNode
+        local = self._local
+        if local.activeNode is not None:
+            return True
+        return local.activeGraphContext is not None and bool(local.activeGraphContext._frames)
 
     def getValue(self, node):
         """Returns the value of the node, recalculating if necessary,
         honoring any active graph context.
 
         """
+        local = self._local
+        if local.activeGraphContext is not None:
+            return local.activeGraphContext._getValue(node)
+        outputNode = local.activeNode
+        if outputNode is None:
+            return self._evaluate(node)
+        if outputNode._inputs is None or node not in outputNode._inputs:
+            outputNode.addInput(node)
+            node.addOutput(outputNode)
+        if node.isValid():
+            return node.getValue()
+        return self._evaluate(node)
+
+    def _evaluate(self, node):
+        """Returns the value of the node with the node active, so
+        that any nodes read while (re)calculating it are recorded
+        as its inputs.
+
+        Edge bookkeeping between the node and whatever node is
+        reading it is left to the caller.
+
+        """
+        # An evaluation started outside of any calculation holds the
+        # graph for reading until it completes.  If another thread is
+        # already calculating the node, wait for it to finish rather
+        # than calculate it again.
+        #
         # TODO: Consider rewriting as a visitor or context.
         #
-        outputNode, self.activeNode = self.activeNode, node
+        local = self._local
+        outputNode = local.activeNode
+        if outputNode is None:
+            self._lock.acquireRead()
         try:
-            if outputNode:
-                outputNode.addInput(node)
-                node.addOutput(outputNode)
+            computation = None
+            while not node.isValid():
+                computation = _Computation()
+                current = self._computations.setdefault(node, computation)
+                if current is computation or current.thread == computation.thread:
+                    break
+                computation = None
+                self._awaitComputation(node, current)
+            local.activeNode = node
+            try:
+                return node.getValue()
+            finally:
+                local.activeNode = outputNode
+                if computation is not None and self._computations.get(node) is computation:
+                    self._finishComputation(node, computation)
+        finally:
+            if outputNode is None:
+                self._lock.releaseRead()
+
+    def _evaluateOutsideContexts(self, node):
+        """Returns the value of the node on the graph itself, ignoring
+        any active graph context.
+
+        """
+        if node._state & (_IsSet | _IsCalced):
             return node.getValue()
+        local = self._local
+        graphContext, local.activeGraphContext = local.activeGraphContext, None
+        try:
+            return self._evaluate(node)
+        finally:
+            local.activeGraphContext = graphContext
+
+    def _storeCalc(self, node, value, inputs):
+        """Stores a value calculated within a context, from the given
+        inputs, on a node none of its overlays affect.
+
+        Other threads may be reading the graph, so the node is claimed
+        as if calculating it, and left alone if another thread is doing
+        so or already has.
+
+        """
+        computation = _Computation()
+        if self._computations.setdefault(node, computation) is not computation:
+            return
+        try:
+            if not node.isValid():
+                node._storeCalc(value, inputs)
         finally:
-            self.activeNode = outputNode
+            self._finishComputation(node, computation)
+
+    def _awaitComputation(self, node, computation):
+        """Waits for another thread to finish calculating a node.
+
+        """
+        with self._computed:
+            computation.waiters += 1
+            while self._computations.get(node) is computation:
+                self._computed.wait()
+
+    def _finishComputation(self, node, computation):
+        """Marks a node as no longer being calculated, waking any
+        threads waiting for it.
+
+        """
+        del self._computations[node]
+        if computation.waiters:
+            with self._computed:
+                self._computed.notify_all()
+
+    def batch(self):
+        """Returns a GraphBatch, which buffers the sets, clears and
+        overlays made within it and applies them together when it
+        exits:
+
+            with graph.batch():
+                o.X = ...
+                o.Y.overlayValue(...)
+
+        """
+        return GraphBatch(self)
+
+    def applyChanges(self, nodeChanges):
+        """Applies a list of NodeChanges as a single batch.
+
+        """
+        with self.batch():
+            for nodeChange in nodeChanges:
+                self.setValue(nodeChange.node, nodeChange.value)
+
+    def _applyChanges(self, changes):
+        """Applies buffered changes, given as (function, args) pairs,
+        deferring the invalidation each would normally trigger and
+        then invalidating the union of the affected cones in a single
+        pass.
+
+        """
+        self._lock.acquireWrite()
+        try:
+            deferred, self._deferredInvalidations = self._deferredInvalidations, []
+            try:
+                for function, args in changes:
+                    function(*args)
+            finally:
+                roots, self._deferredInvalidations = self._deferredInvalidations, deferred
+                if deferred is not None:
+                    deferred.extend(roots)
+                else:
+                    outputs = []
+                    for root in set(roots):
+                        outputs.extend(root.outputs)
+                    _invalidateCalcs(outputs)
+        finally:
+            self._lock.releaseWrite()
 
     def setValue(self, node, value):
         """Sets for value of a node, and raises an exception
@@ -66,7 +812,43 @@ class Graph(object):
         """
         if self.isComputing():
             raise RuntimeError("You cannot set a node during graph evaluation.")
-        node.setValue(value)
+        if self._local.pendingChanges is not None:
+            if not node.graphMethod.isSettable():
+                raise RuntimeError("You cannot set a read-only node.")
+            self._local.pendingChanges.append((node.setValue, (value,)))
+            return
+        self._applyChanges([(node.setValue, (value,))])
+
+    def _setNewObjects(self, graphMethod, graphObjects, values):
+        """Sets a no-argument settable method of newly created objects
+        to the given values, writing the nodes' state directly: nothing
+        can have been calculated from them yet, so there is nothing to
+        invalidate.
+
+        """
+        if self.isComputing():
+            raise RuntimeError("You cannot set a node during graph evaluation.")
+        if not graphMethod.isSettable() or graphMethod.isBatched():
+            raise RuntimeError("You cannot set a read-only node.")
+        name = graphMethod.name
+        if graphMethod.delegatesChanges():
+            for graphObject, value in zip(graphObjects, values):
+                getattr(graphObject, name).setValue(value)
+            return
+        nodes = self.nodes
+        self._lock.acquireWrite()
+        try:
+            for graphObject, value in zip(graphObjects, values):
+                graphInstanceMethod = graphObject.__dict__.get(name) or graphMethod.__get__(graphObject)
+                node = graphInstanceMethod._nodes.get(())
+                if node is None:
+                    node = graphInstanceMethod._nodes[()] = nodes[(id(graphObject), name)] = \
+                            Node(graphObject, graphMethod)
+                node._setValue = value
+                node._state |= _IsSet
+                self._setChanged(node)
+        finally:
+            self._lock.releaseWrite()
 
     def clearSet(self, node):
         """Clears the current node if it has been set.
@@ -81,7 +863,12 @@ class Graph(object):
         """
         if self.isComputing():
             raise RuntimeError("You cannot clear a set value during graph evaluation.")
-        node.clearSet()
+        if self._local.pendingChanges is not None:
+            if not node.graphMethod.isSettable():
+                raise RuntimeError("You cannot clear a read-only node.")
+            self._local.pendingChanges.append((node.clearSet, ()))
+            return
+        self._applyChanges([(node.clearSet, ())])
 
     def overlayValue(self, node, value):
         """Adds a overlay to the active graph context and immediately applies it to the node.
@@ -91,8 +878,28 @@ class Graph(object):
             raise RuntimeError("You cannot overlay a node during graph evaluation.")
         if not self.activeGraphContext:
             raise RuntimeError("You cannot overlay a node outside a graph context.")
+        if self._local.pendingChanges is not None:
+            if not node.graphMethod.isOverlayable():
+                raise RuntimeError("You cannot overlay this node.")
+            self._local.pendingChanges.append((self.activeGraphContext.overlayValue, (node, value)))
+            return
+
+        # Overlays live in the context, which is only active in this
+        # thread, so there is no need to hold the graph for writing.
+        #
         self.activeGraphContext.overlayValue(node, value)
 
+    def isOverlaid(self, node):
+        """Returns True if an active graph context overlays the node.
+
+        """
+        graphContext = self.activeGraphContext
+        while graphContext is not None:
+            if node in graphContext._layerOverlays:
+                return True
+            graphContext = graphContext._enclosing
+        return False
+
     def clearOverlay(self, node):
         """Clears an overlay previously set in the active graph context.
 
@@ -101,8 +908,52 @@ class Graph(object):
             raise RuntimeError("You cannot clear a overlay during graph evaluation.")
         if not self.activeGraphContext:
             raise RuntimeError("You cannot clear a overlay outside a graph context.")
+        if self._local.pendingChanges is not None:
+            self._local.pendingChanges.append((self.activeGraphContext.clearOverlay, (node,)))
+            return
         self.activeGraphContext.clearOverlay(node)
 
+# A change to the set value of a Saved node, as of the time it was read:
+# the version of the change, the node's object, method name and args,
+# and whether it is set and, if so, its value.
+#
+SavedChange = collections.namedtuple('SavedChange', 'version graphObject name args isSet value')
+
+class GraphBatch(object):
+    """A batch of graph changes.
+
+    Sets, clears and overlays made while a batch is open are buffered
+    rather than applied, so reads within the batch still see the graph
+    as it was before it.  When the outermost batch exits the changes
+    are applied in order, followed by a single invalidation pass over
+    the union of the nodes they affect, so a node shared by many
+    changed inputs is invalidated once rather than once per change.
+
+    If the batch exits with an exception its changes are discarded.
+
+    Batches nest; only the outermost one applies the changes.  Each
+    thread has its own batch.
+
+    """
+    def __init__(self, graph):
+        self._graph = graph
+        self._outermost = False
+
+    def __enter__(self):
+        if self._graph._local.pendingChanges is None:
+            self._graph._local.pendingChanges = []
+            self._outermost = True
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if not self._outermost:
+            return
+        self._outermost = False
+        local = self._graph._local
+        changes, local.pendingChanges = local.pendingChanges, None
+        if excType is None:
+            self._graph._applyChanges(changes)
+
 class GraphVisitor(object):
     """Visits a hierarchy of graph nodes in depth first order.
 
@@ -128,9 +979,193 @@ class GraphVisitor(object):
         """
         raise NotImplementedError()
 
+class _HamtNode(object):
+    """A node of a _PersistentMap's trie: a bitmap of the 32 slots in
+    use and, in slot order, an entry for each.  An entry is either a
+    (key, value) pair or the node for the next five bits of the hash.
+
+    """
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+class _HamtCollision(object):
+    """The (key, value) pairs whose keys' hashes are all equal."""
+    __slots__ = ('entries',)
+
+    def __init__(self, entries):
+        self.entries = entries
+
+_hashMask = 0xffffffff
+_emptyHamtNode = _HamtNode(0, ())
+
+def _bitCount(bits):
+    return bin(bits).count('1')
+
+def _hamtGet(node, h, key, default):
+    shift = 0
+    while True:
+        if type(node) is _HamtCollision:
+            for k, v in node.entries:
+                if k is key or k == key:
+                    return v
+            return default
+        bit = 1 << ((h >> shift) & 31)
+        if not node.bitmap & bit:
+            return default
+        entry = node.entries[_bitCount(node.bitmap & (bit - 1))]
+        if type(entry) is tuple:
+            k = entry[0]
+            if k is key or k == key:
+                return entry[1]
+            return default
+        node = entry
+        shift += 5
+
+def _hamtSet(node, h, shift, key, value):
+    """Returns (node, added) for the trie with the key set, sharing
+    every node but those on the key's path.
+
+    """
+    if type(node) is _HamtCollision:
+        entries = list(node.entries)
+        for i, (k, v) in enumerate(entries):
+            if k is key or k == key:
+                if v is value:
+                    return node, False
+                entries[i] = (key, value)
+                return _HamtCollision(tuple(entries)), False
+        return _HamtCollision(node.entries + ((key, value),)), True
+    bit = 1 << ((h >> shift) & 31)
+    index = _bitCount(node.bitmap & (bit - 1))
+    entries = node.entries
+    if not node.bitmap & bit:
+        return _HamtNode(node.bitmap | bit, entries[:index] + ((key, value),) + entries[index:]), True
+    entry = entries[index]
+    if type(entry) is tuple:
+        k, v = entry
+        if k is key or k == key:
+            if v is value:
+                return node, False
+            entry, added = (key, value), False
+        else:
+            entry, added = _hamtMerge(entry, hash(k) & _hashMask, (key, value), h, shift + 5), True
+    else:
+        newEntry, added = _hamtSet(entry, h, shift + 5, key, value)
+        if newEntry is entry:
+            return node, False
+        entry = newEntry
+    return _HamtNode(node.bitmap, entries[:index] + (entry,) + entries[index + 1:]), added
+
+def _hamtMerge(entry1, h1, entry2, h2, shift):
+    if shift > 30:
+        return _HamtCollision((entry1, entry2))
+    i1 = (h1 >> shift) & 31
+    i2 = (h2 >> shift) & 31
+    if i1 == i2:
+        return _HamtNode(1 << i1, (_hamtMerge(entry1, h1, entry2, h2, shift + 5),))
+    if i1 > i2:
+        entry1, entry2 = entry2, entry1
+    return _HamtNode((1 << i1) | (1 << i2), (entry1, entry2))
+
+def _hamtDiscard(node, h, shift, key):
+    """Returns (entry, removed) for the trie without the key, where
+    entry is None if nothing is left, or the (key, value) pair if only
+    that is left below the root.
+
+    """
+    if type(node) is _HamtCollision:
+        entries = tuple(entry for entry in node.entries if not (entry[0] is key or entry[0] == key))
+        if len(entries) == len(node.entries):
+            return node, False
+        if len(entries) == 1:
+            return entries[0], True
+        return _HamtCollision(entries), True
+    bit = 1 << ((h >> shift) & 31)
+    if not node.bitmap & bit:
+        return node, False
+    index = _bitCount(node.bitmap & (bit - 1))
+    entries = node.entries
+    entry = entries[index]
+    if type(entry) is tuple:
+        if not (entry[0] is key or entry[0] == key):
+            return node, False
+        entry = None
+    else:
+        entry, removed = _hamtDiscard(entry, h, shift + 5, key)
+        if not removed:
+            return node, False
+    if entry is not None:
+        return _HamtNode(node.bitmap, entries[:index] + (entry,) + entries[index + 1:]), True
+    entries = entries[:index] + entries[index + 1:]
+    if not entries:
+        return None, True
+    if shift and len(entries) == 1 and type(entries[0]) is tuple:
+        return entries[0], True
+    return _HamtNode(node.bitmap & ~bit, entries), True
+
+def _hamtItems(node):
+    stack = [node]
+    while stack:
+        for entry in stack.pop().entries:
+            if type(entry) is tuple:
+                yield entry
+            else:
+                stack.append(entry)
+
+class _PersistentMap(object):
+    """An immutable mapping, held as a hash array mapped trie.
+
+    set() and discard() return a new map sharing all but the O(log n)
+    nodes on the key's path with the original, so a map is copied by
+    reference and a copy costs only what is changed in it.
+
+    """
+    __slots__ = ('_root', '_size')
+
+    def __init__(self, root=_emptyHamtNode, size=0):
+        self._root = root
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return _hamtGet(self._root, hash(key) & _hashMask, key, _noValue) is not _noValue
+
+    def __getitem__(self, key):
+        value = _hamtGet(self._root, hash(key) & _hashMask, key, _noValue)
+        if value is _noValue:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        return (key for key, value in _hamtItems(self._root))
+
+    def get(self, key, default=None):
+        return _hamtGet(self._root, hash(key) & _hashMask, key, default)
+
+    def items(self):
+        return list(_hamtItems(self._root))
+
+    def set(self, key, value):
+        """Returns a map with the key set to the value."""
+        root, added = _hamtSet(self._root, hash(key) & _hashMask, 0, key, value)
+        if root is self._root:
+            return self
+        return _PersistentMap(root, self._size + added)
+
+    def discard(self, key):
+        """Returns a map without the key."""
+        root, removed = _hamtDiscard(self._root, hash(key) & _hashMask, 0, key)
+        if not removed:
+            return self
+        return _PersistentMap(root or _emptyHamtNode, self._size - 1)
+
 # TODO: Split collections of overlays from the contexts.
 # TODO: Decouple this from the graph, making graph a paramter to __init__?
-# TODO: Store nodes in contexts, vs some special global.
 
 class GraphContext(object):
     """A graph context is collection of temporary node changes
@@ -159,7 +1194,34 @@ class GraphContext(object):
     second case are not saved to the context.
 
     One can also create a GraphContext that inherits nodes
-    from a parent context.
+    from a parent context (see fork()).
+
+    Overlays are never applied to the nodes themselves.  An active
+    context is a layer over the graph (or over the context active when
+    it was entered): it holds its overlays and the values calculated
+    within it that they affect, and reads through to the layer beneath
+    for everything else.  A value calculated within a context that no
+    overlay of its own affects is stored in the layer beneath, so
+    entering and exiting a context leaves the graph's values intact.
+
+    A context keeps its values when it exits.  Entering it again
+    reuses them, provided its overlays and the sets and overlays
+    beneath it are unchanged.
+
+    A child context is entered as a layer over its parent, which is
+    entered beneath it if it is not already active, so it holds only
+    the values its own overlays affect and shares the rest with its
+    parent and its siblings.  The exception is a child that clears an
+    overlay it inherits, which is entered as a layer with all of its
+    overlays instead.
+
+    A thread inside a context holds the graph for reading, so other
+    threads carry on evaluating the graph (without its overlays) and
+    entering contexts of their own, while their sets wait for it to
+    exit.  A context is active in one thread at a time: entering one
+    that is active in another thread raises a RuntimeError, and a
+    child whose parent is active in another thread is entered with
+    all of its overlays.
 
     """
     def __init__(self, graph=None, parentGraphContext=None):
@@ -176,11 +1238,38 @@ class GraphContext(object):
         #
         self._graph = graph or _graph
         self._parentGraphContext = parentGraphContext
-        self._overlays = {}           # Node overlays by node.
-        self._state = {}              # Node values by node.
-        self._applied = set()         # Nodes whose overlays in this context have been applied.
+        self._overlays = _PersistentMap()  # Node overlays by node.
         self._removed = set()         # Nodes set at a higher level but cleared here.
+        self._version = 0             # Advanced by every change to the overlays below.
         self._populating = True
+        self._graph._contexts.add(self)
+
+        # The overlays in effect, including those inherited from the
+        # parent, are kept flattened so any one of them can be looked
+        # up directly.  The maps are persistent, so a child starts out
+        # sharing its parent's and pays only for what it changes.  A
+        # change to a context's overlays is pushed down to its children.
+        #
+        self._flattened = parentGraphContext._flattened if parentGraphContext else _PersistentMap()
+        self._children = weakref.WeakSet()
+        if parentGraphContext:
+            parentGraphContext._children.add(self)
+
+        # The layer, kept from one activation to the next.
+        #
+        self._active = False
+        self._owner = None            # The ident of the thread the context is active in.
+        self._enclosing = None        # The context active when this one was entered.
+        self._level = 0               # The number of contexts active, counting this one.
+        self._layerOverlays = None    # Overlay values in effect, by node.
+        self._shared = False          # Whether the layer is over the parent's, holding only our overlays.
+        self._pushedParent = False    # Whether the parent was entered beneath us when we were.
+        self._values = None           # (value, inputs) pairs by node, for nodes the overlays affect.
+        self._unaffected = None       # Nodes whose values are those of the layer beneath.
+        self._frames = []             # The (inputs, deepest layer, inputs in order read) of each calculation in progress.
+        self._token = None            # Identifies the current values, for layers above.
+        self._revision = None         # The graph revision the values were calculated at.
+        self._layerKey = None         # What the values were calculated on top of, on exit.
 
     def addOverlay(self, node, value):
         """Adds a new overlay to the graph context, but does not apply it to the node.
@@ -188,9 +1277,10 @@ class GraphContext(object):
         If an existing overlay is already set, replaces its value.
 
         """
-        self._overlays[node] = value
+        self._overlays = self._overlays.set(node, value)
         if node in self._removed:
             self._removed.remove(node)
+        self._overlayChanged(node)
 
     def removeOverlay(self, node):
         """Removes an overlay from the graph context, but does not unapply it from
@@ -198,90 +1288,160 @@ class GraphContext(object):
 
         """
         self._removed.add(node)
-        if node in self._overlays:
-            del self._overlays[node]
+        self._overlays = self._overlays.discard(node)
+        self._overlayChanged(node)
+
+    def _overlayChanged(self, node):
+        """Brings the flattened overlay for a node up to date in this
+        context and in any descendants that inherit it.
+
+        """
+        worklist = [self]
+        while worklist:
+            graphContext = worklist.pop()
+            graphContext._version += 1
+            parent = graphContext._parentGraphContext
+            value = graphContext._overlays.get(node, _noValue)
+            if value is _noValue and node not in graphContext._removed and parent:
+                value = parent._flattened.get(node, _noValue)
+            if value is _noValue:
+                graphContext._flattened = graphContext._flattened.discard(node)
+            else:
+                graphContext._flattened = graphContext._flattened.set(node, value)
+            for child in graphContext._children:
+                if node not in child._overlays and node not in child._removed:
+                    worklist.append(child)
 
     def overlayValue(self, node, value):
-        """Adds an overlay to the graph context and immediately applies it to
-        the node.
+        """Adds an overlay to the graph context and, if the context is
+        active, immediately applies it to the node.
+
+        Once the context has been populated, overlays applied while it
+        is active are not saved to it.
 
         """
-        self.addOverlay(node, value)
-        self.applyOverlay(node)
+        if not node.graphMethod.isOverlayable():
+            raise RuntimeError("You cannot overlay this node.")
+        if self._populating or not self._active:
+            self.addOverlay(node, value)
+        if self._active:
+            self._applyOverlay(node, value)
 
     def applyOverlay(self, node):
-        """Applies an overlay to a node, stashing away any existing
-        overlays (from another graph context) that were inherited so we can
-        reapply them later.
+        """Applies the context's overlay for a node, which takes
+        precedence over any overlay applied beneath it.
 
         """
-        # FIXME: State handling is a bit too coupled here, I think.
-        if node.isOverlaid() and node not in self._applied:
-            self._state[node] = node.getOverlay()
-        node.overlayValue(self.getOverlay(node))
-        self._applied.add(node)
+        self._applyOverlay(node, self.getOverlay(node))
+
+    def _applyOverlay(self, node, value):
+        if not node.graphMethod.isOverlayable():
+            raise RuntimeError("You cannot overlay this node.")
+        revalued = node in self._layerOverlays
+        if self._populating:
+            self._layerOverlays = self._layerBasis()
+        else:
+            self._layerOverlays = self._layerOverlays.set(node, value)
+        self._overlaysChanged(revalued)
 
     def clearOverlay(self, node):
-        """Removes the overlay from the node, restoring old state,
-        and, if this overlay was in the current graph context, also
-        removes it from the overlay data.
+        """Removes the overlay from the node, revealing whatever lies
+        beneath it, and, while populating the context, also removes it
+        from the overlay data.
 
         """
-        # If the node was overlaid in this graph context, we need to restore any
-        # existing overlays that may have been applied outside of this
-        # graph context. 
-        #
-        # If we're populating, remove it from the context as well.  
-        #
-        # TODO: I'm refactoring this now that I have a better handle 
-        #       on the interactions between contexts.  I wanted to get 
-        #       something out people could use first, kinks and all.
-        #
         if self.isOverlaid(node):
-            # If the node had a value that we stashed away, restore it.
-            # Otherwise, clear it.
-            if node in self._state:
-                # TODO: I re-overlay here - which kind of seems wrong in that the
-                #       original overlay was never really "removed," but at present
-                #       will work for our cases.  This also has the side-effect 
-                #       of invalidating the parent node, which again is something
-                #       we want because the node was invalidated when we applied
-                #       our overlays.  Nevertheless, it'd be nice to merely preserve
-                #       the original state and avoid the recalculation of the 
-                #       parent nodes if they really don't need to be recalculated.
-                #       I believe this should be straight-forward once we have sets
-                #       fully isolated.
-                #
-                #       Also we don't clear our existing overlay here, relying on
-                #       fact that overlaying the node will essentially do that for us.
-                #
-                node.overlayValue(self._state[node])
-                del self._state[node]
-            else:
-                node.clearOverlay()
+            if self._shared and self._parentGraphContext.isOverlaid(node):
+                self._unshare()
             if self._populating:
                 self.removeOverlay(node)
-            self._applied.remove(node)
+                self._layerOverlays = self._layerBasis()
+            else:
+                self._layerOverlays = self._layerOverlays.discard(node)
+            self._overlaysChanged()
+
+    def _layerBasis(self):
+        """Returns the overlays the layer holds while they are those
+        of the context.
+
+        """
+        return self._overlays if self._shared else self._flattened
+
+    def _unshare(self):
+        """Folds the overlays of the parent's layer into this one, and
+        exits the parent if it was entered beneath this context, so an
+        inherited overlay can be cleared.
+
+        """
+        graph = self._graph
+        overlays = self._layerOverlays
+        graphContext = self
+        while graphContext._shared:
+            beneath = graphContext._enclosing
+            for node, value in beneath._layerOverlays.items():
+                if node not in overlays:
+                    overlays = overlays.set(node, value)
+            if not graphContext._pushedParent:
+                break
+            graphContext = beneath
+        if self._pushedParent:
+            active = graph.activeGraphContext
+            self._pushedParent = False
+            with graph._contextLock:
+                self._enclosing._exitLayer()
+            self._enclosing = graph.activeGraphContext
+            graph.activeGraphContext = active
+            layers = []
+            while active is not None:
+                layers.append(active)
+                active = active._enclosing
+            for level, layer in enumerate(reversed(layers), 1):
+                layer._level = level
+        self._shared = False
+        self._layerOverlays = overlays
+
+    def _overlaysChanged(self, revalued=False):
+        """Discards the values calculated in this layer and in any
+        layers above it, which may depend on the overlays.
+
+        If an overlay only changed value, the nodes known not to read
+        it still don't, so they are kept as unaffected and only the
+        nodes that do read it are calculated again.
+
+        """
+        graphContext = self._graph.activeGraphContext
+        while graphContext is not None and graphContext is not self:
+            graphContext._clearValues(revalued)
+            graphContext = graphContext._enclosing
+        self._clearValues(revalued)
+
+    def _clearValues(self, keepUnaffected=False):
+        self._values = {}
+        if not keepUnaffected:
+            self._unaffected = set()
+        self._token = object()
+        self._revision = self._graph._revision
+        self._layerKey = None
 
     def isOverlaid(self, node):
         """Return True if an overlay in this graph context (or any of its parents)
         is active on the node.
 
         """
-        return node in self._applied
+        if not self._active:
+            return False
+        if node in self._layerOverlays:
+            return True
+        return self._shared and self._parentGraphContext.isOverlaid(node)
 
     def hasOverlay(self, node, includeParent=True):
         """Returns True if an overlay exists for the node in this
         graph context.
 
         """
-        if node in self._removed:
-            return False
-        if node in self._overlays:
-            return True
-        if includeParent and self._parentGraphContext:
-            return self._parentGraphContext.hasOverlay(node)
-        return False
+        if includeParent:
+            return node in self._flattened
+        return node in self._overlays
 
     def allOverlays(self, includeParent=True):
         """Returns a list of all overlays presnet in the graph context.
@@ -291,13 +1451,9 @@ class GraphContext(object):
         in this graph context.
 
         """
-        if not includeParent or not self._parentGraphContext:
-            return self._overlays.copy()
-        overlays = self._parentGraphContext.allOverlays()
-        overlays.update(self._overlays)
-        for removed in self._removed:
-            overlays.pop(removed)
-        return overlays
+        if includeParent:
+            return dict(self._flattened.items())
+        return dict(self._overlays.items())
 
     def getOverlay(self, node, includeParent=True):
         """Returns the overlay for the specified
@@ -307,33 +1463,236 @@ class GraphContext(object):
         not exist.
 
         """
-        return self.allOverlays(includeParent=includeParent)[node]
+        if includeParent:
+            return self._flattened[node]
+        return self._overlays[node]
+
+    def fork(self):
+        """Returns a new context that inherits this one's overlays.
+
+        Nothing is copied, so forking costs the same however many
+        overlays the context has; the child pays only for the overlays
+        it changes and the values they affect.
+
+        """
+        return GraphContext(graph=self._graph, parentGraphContext=self)
+
+    def _getValue(self, node):
+        """Returns the value of the node within the context, recording
+        it as an input of the calculation in progress, if any.
+
+        """
+        if self._revision != self._graph._revision:
+            graphContext = self
+            while graphContext is not None:
+                graphContext._clearValues()
+                graphContext = graphContext._enclosing
+        value, layer = self._resolve(node)
+        if self._frames:
+            frame = self._frames[-1]
+            if node not in frame[0]:
+                frame[0].add(node)
+                frame[2].append(node)
+            if layer is not None and (frame[1] is None or layer._level > frame[1]._level):
+                frame[1] = layer
+        return value
+
+    def _resolve(self, node):
+        """Returns (value, layer) for the node, where layer is the
+        context whose overlays determine the value, or None if none
+        do and the value is the graph's own.
+
+        """
+        value, layer = self._lookup(node)
+        if value is not _noValue:
+            return value, layer
+
+        # If the value beneath is known, and none of the inputs it
+        # was calculated from are affected here, it is the value here
+        # as well.  Whether an input is affected may depend on its own
+        # inputs in turn, so they are checked depth-first with an
+        # explicit stack, however deep the chain.  An input met again
+        # on the current path (across an edge the graph has yet to
+        # reconcile) is taken to be affected.
+        #
+        stack = [[node, layer._peekBeneath(node), None]]
+        onPath = set([node])
+        settled = None      # The (value, layer) of the input last settled.
+        while True:
+            frame = stack[-1]
+            node, known, inputs = frame
+            if known is None or settled is not None and settled[1] is self:
+                settled = self._calculate(node)
+            else:
+                settled = None
+                if inputs is None:
+                    inputs = frame[2] = iter(known[1])
+                for inputNode in inputs:
+                    if inputNode in onPath:
+                        settled = self._calculate(node)
+                        break
+                    value, layer = self._lookup(inputNode)
+                    if value is _noValue:
+                        stack.append([inputNode, layer._peekBeneath(inputNode), None])
+                        onPath.add(inputNode)
+                        break
+                    if layer is self:
+                        settled = self._calculate(node)
+                        break
+                else:
+                    self._markUnaffected(node, known[2])
+                    settled = known[0], known[2]
+                if settled is None:
+                    continue
+            stack.pop()
+            onPath.discard(node)
+            if not stack:
+                return settled
+
+    def _lookup(self, node):
+        """Returns (value, layer) for the node, as _resolve does, if
+        its value is known without checking its inputs.  Otherwise
+        returns (_noValue, layer), where layer is the one whose value
+        beneath it must be checked.
+
+        """
+        layer = self
+        while layer is not None:
+            value = layer._layerOverlays.get(node, _noValue)
+            if value is not _noValue:
+                return value, layer
+            entry = layer._values.get(node)
+            if entry is not None:
+                return entry[0], layer
+            if node not in layer._unaffected and not node._state & _IsSet:
+                return _noValue, layer
+            layer = layer._enclosing
+        return self._graph._evaluateOutsideContexts(node), None
+
+    def _peekBeneath(self, node):
+        """Returns (value, inputs, layer) for the node's value in the
+        layers beneath this one, if it is known without calculating.
+
+        An overlay beneath is always known, even past layers that have
+        yet to see the node.
+
+        """
+        known = True
+        layer = self._enclosing
+        while layer is not None:
+            value = layer._layerOverlays.get(node, _noValue)
+            if value is not _noValue:
+                return value, (), layer
+            if known:
+                entry = layer._values.get(node)
+                if entry is not None:
+                    return entry[0], entry[1], layer
+                known = node in layer._unaffected
+            layer = layer._enclosing
+        if known and node._state & _IsCalced:
+            return node._calcedValue, list(node._inputOrder or ()), None
+        return None
+
+    def _markUnaffected(self, node, layer):
+        """Notes that the node's value in this layer, and those down
+        to the given one, is the value in the given layer.
+
+        """
+        graphContext = self
+        while graphContext is not layer:
+            graphContext._unaffected.add(node)
+            graphContext = graphContext._enclosing
+
+    def _calculate(self, node):
+        """Calculates the node within the context and stores the value
+        in the deepest layer it can: the one holding the deepest of the
+        overlays it was calculated from.
+
+        """
+        frame = [set(), None, []]
+        self._frames.append(frame)
+        try:
+            value = node.graphMethod(node.graphObject, *node.args)
+        finally:
+            self._frames.pop()
+        inputs, layer, order = frame
+        if layer is None:
+            self._graph._storeCalc(node, value, order)
+        else:
+            layer._values[node] = (value, tuple(order))
+        self._markUnaffected(node, layer)
+        return value, layer
 
     def __enter__(self):
         """Enter the graph context, activating any overlays it contains.
 
         Note that overlays always override already-applied overlays, so
-        if overlays have been applied in a higher graph context, stash those
-        away to be restored when we exit the current context.
+        if overlays have been applied in a higher graph context, the
+        ones in this context take precedence until it exits.
+
+        Raises a RuntimeError if the context is already active.
 
         """
         # TODO: Differentiate between "with GraphContext() as c" and "with c":
         #       the latter should not update the context when new overlays are
         #       added or removed.
         #
-        self.activeParentGraphContext, self._graph.activeGraphContext = self._graph.activeGraphContext, self
-
-        # If we're not populating, create a dummy context to collect overlay changes that
-        # we don't want to store to the the actual context.
-        #
-        # I'm probably going to break this into two contexts at some point.
-        #
-        if not self._populating:
-            self._graph.activeGraphContext = GraphContext(parentGraphContext=self._graph.activeGraphContext)
-        for node in self._graph.activeGraphContext.allOverlays():
-            self._graph.activeGraphContext.applyOverlay(node)
+        graph = self._graph
+        if graph.isComputing():
+            raise RuntimeError("You cannot enter a graph context during graph evaluation.")
+        graph._lock.acquireRead()
+        try:
+            with graph._contextLock:
+                self._enterLayer()
+        except:
+            graph._lock.releaseRead()
+            raise
         return self
 
+    def _enterLayer(self):
+        """Makes the context the active layer, reusing its values if
+        they are still valid.
+
+        """
+        graph = self._graph
+        if self._active:
+            if self._owner != get_ident():
+                raise RuntimeError("This graph context is active in another thread.")
+            layer = graph.activeGraphContext
+            while layer is not None:
+                if layer._enclosing is self and layer._pushedParent:
+                    raise RuntimeError("This graph context is already active beneath a context forked from it.")
+                layer = layer._enclosing
+            raise RuntimeError("This graph context is already active.")
+        enclosing = graph.activeGraphContext
+        parent = self._parentGraphContext
+        shared = (parent is not None and (enclosing is parent or not parent._active) and
+                  not any(node in parent._flattened for node in self._removed))
+        pushed = shared and enclosing is not parent
+        if pushed:
+            parent._enterLayer()
+            enclosing = parent
+        try:
+            overlays = self._overlays if shared else self._flattened
+            layerKey = (graph._revision, self._version, enclosing and enclosing._token, shared)
+            if self._layerKey != layerKey:
+                for node in overlays:
+                    if not node.graphMethod.isOverlayable():
+                        raise RuntimeError("You cannot overlay this node.")
+                self._layerOverlays = overlays
+                self._clearValues()
+        except:
+            if pushed:
+                parent._exitLayer()
+            raise
+        self._shared = shared
+        self._pushedParent = pushed
+        self._enclosing = enclosing
+        self._level = enclosing._level + 1 if enclosing else 1
+        self._active = True
+        self._owner = get_ident()
+        graph.activeGraphContext = self
+
     def __exit__(self, *args):
         """Exit the graph context and remove any applied overlays.
 
@@ -342,9 +1701,83 @@ class GraphContext(object):
         #
         if self._populating:
             self._populating = False
-        for node in self._graph.activeGraphContext.allOverlays():
-            self._graph.activeGraphContext.clearOverlay(node)
-        self._graph.activeGraphContext = self.activeParentGraphContext
+        graph = self._graph
+        try:
+            with graph._contextLock:
+                self._exitLayer()
+        finally:
+            graph._lock.releaseRead()
+
+    def _exitLayer(self):
+        """Restores the layer beneath, and exits the parent if it was
+        entered beneath this context.
+
+        """
+        graph = self._graph
+        if self._revision == graph._revision and self._layerOverlays is self._layerBasis():
+            self._layerKey = (graph._revision, self._version, self._enclosing and self._enclosing._token, self._shared)
+        else:
+            self._layerKey = None
+        graph.activeGraphContext = self._enclosing
+        self._active = False
+        self._owner = None
+        self._enclosing = None
+        if self._pushedParent:
+            self._pushedParent = False
+            self._parentGraphContext._exitLayer()
+
+    @classmethod
+    def evaluateScenarios(cls, scenarios, targets, processes=None, graph=None):
+        """Evaluates the target nodes under each of many scenarios,
+        spreading the scenarios across a pool of worker processes.
+
+        scenarios is a sequence of graph contexts or of dictionaries
+        of overlay values by node, and targets is a sequence of nodes.
+        Either may give a node by its GraphInstanceMethod if it takes
+        no arguments.
+
+        Yields an (index, values) pair for each scenario as it
+        completes, in no particular order, where values is the list of
+        target values under scenarios[index].  Values must be picklable.
+
+        Each worker is forked from the calling process, so it starts
+        from the graph as it stands (including any active context) and
+        keeps the values it calculates from one scenario to the next.
+        Where processes cannot be forked, or processes is 1, the
+        scenarios are evaluated in turn in this process.
+
+        """
+        graph = graph or _graph
+        scenarios = list(scenarios)
+        targets = [_asNode(target) for target in targets]
+        if graph.isComputing():
+            raise RuntimeError("You cannot evaluate scenarios during graph evaluation.")
+        if processes == 1 or len(scenarios) < 2 or not hasattr(os, 'fork'):
+            job = (graph, scenarios, targets)
+            for index in range(len(scenarios)):
+                yield _evaluateScenario(index, job)
+            return
+
+        # Fork while holding the graph for writing, so no other thread
+        # is part way through changing or calculating it.
+        #
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:
+            context = multiprocessing
+        graph._lock.acquireWrite()
+        try:
+            pool = context.Pool(processes, _initScenarioWorker, (graph, scenarios, targets))
+        finally:
+            graph._lock.releaseWrite()
+        try:
+            chunksize = max(1, len(scenarios) // (4 * (processes or multiprocessing.cpu_count())))
+            for result in pool.imap_unordered(_evaluateScenario, range(len(scenarios)), chunksize):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
 class GraphMethod(object):
     """An unbound graph-enabled method.
@@ -354,7 +1787,7 @@ class GraphMethod(object):
 
     """
 
-    def __init__(self, method, name, flags=0, delegateTo=None):
+    def __init__(self, method, name, flags=0, delegateTo=None, equality=None, batched=False):
         """Creates a new graph method, which lifts a regular method
         into a version that supports graph-based dependency
         tracking and other graph features.
@@ -386,11 +1819,25 @@ class GraphMethod(object):
         each of which is a mapping between a GraphInstanceMethod (and
         any arguments specific to its node) and the value it will be set to.
 
+        equality is optional and if provided must be a callable taking
+        two values and returning True if they are equivalent.  When
+        the graph's earlyCutoff is enabled, a node whose recalculated
+        value is equivalent to its previous value does not cause the
+        nodes that depend on it to be recalculated.  By default values
+        are compared with ==.
+
+        batched is optional and if True the method must take a single
+        argument and be vectorized: it is called with an array of
+        arguments (a NumPy array, if NumPy is installed) and returns a
+        sequence of their values.  See NodeFamily.
+
         """
         self.method = method
         self.name = name
         self.flags = flags
         self.delegateTo = delegateTo
+        self.equality = equality or _valuesEqual
+        self.batched = batched
 
     def isSettable(self):
         """Returns True if a bound instance of the
@@ -437,11 +1884,33 @@ class GraphMethod(object):
         """
         return self.delegateTo is not None
 
+    def isBatched(self):
+        """Returns True if the method is vectorized over arrays of
+        arguments.
+
+        """
+        return self.batched
+
+    def __get__(self, graphObject, cls=None):
+        """Binds the method to a GraphObject the first time it is looked
+        up on it.
+
+        The GraphInstanceMethod is kept in the object's dictionary, which
+        takes precedence over a descriptor without __set__, so later
+        lookups find it there without calling this again.
+
+        """
+        if graphObject is None:
+            return self
+        return graphObject.__dict__.setdefault(self.name, GraphInstanceMethod(graphObject, self))
+
     def __call__(self, graphObject, *args):
         """A short-cut to calling the underlying method with the supplied
         arguments.
 
         """
+        if self.batched:
+            return self.method(graphObject, _asArray(args))[0]
         return self.method(graphObject, *args)
 
 # TODO: Move the value setting stuff out of Node.  Let's just create
@@ -482,6 +1951,18 @@ class Node(object):
     by the arguments used to call it.
 
     """
+    # There can be a great many nodes on a graph, so they are kept
+    # compact: no instance dictionary, a single integer of state bits
+    # and input/output sets that are only allocated once an edge
+    # exists (most leaf nodes never have inputs).
+    #
+    __slots__ = (
+        'graphObject', 'graphMethod', 'args',
+        '_inputs', '_inputOrder', '_outputs', '_state', '_height',
+        '_setValue', '_calcedValue',
+        '__weakref__',
+        )
+
     def __init__(self, graphObject, graphMethod, args=()):
         """Creates a new node on the graph.
 
@@ -503,32 +1984,38 @@ class Node(object):
         # value (or returning it if already set) and for invalidating
         # anything that relies upon it.
         #
+        # Outputs are held by weak reference: a node keeps the nodes it
+        # depends on alive, but not the nodes that depend on it.
+        #
         # TODO: I may want to model these more generally as edges,
         #       allowing us to set attributes on them, but for now
         #       the two lists will suffice.
         #       
-        self._outputs = set()
-        self._inputs = set()
-
-        # TODO: This is a hack.  If I set a value and then
-        #       overlay its value, for example, there's no immediate reason
-        #       I shouldn't be able to merely restore the old value.
-        #       For now this state is maintaineded here, which works 
-        #       on the assumption that setting a node is a context-independent
-        #       operation but overlaying it is temporary and graph context-
-        #       specific.
-        #
-        self._isOverlaid = False
-        self._isSet = False
-        self._isCalced = False
-
-        # TODO:  I'm maintaining values for overlays, sets, and calcs 
-        #        each in a separate namespace, which is necessary 
-        #        if we wish to reavoid calculating when, for example,
-        #        overlays are set, but maintaining them within the node 
-        #        itself is questionable.  I need to rethink this.
-        #
-        self._overlaidValue = None
+        self._outputs = None
+        self._inputs = None
+
+        # The inputs are also listed in the order they were first read,
+        # so that a stale node can check them in the order its method
+        # would.
+        #
+        self._inputOrder = None
+
+        # A node's height is greater than that of any of its inputs,
+        # which lets the graph bring nodes up to date in topological
+        # order.  Heights only ever grow.
+        #
+        self._height = 0
+
+        # Setting a node is a context-independent operation, so set
+        # values live here.  Overlays are temporary and graph context-
+        # specific, so they (and the values calculated from them) live
+        # in the contexts.
+        #
+        self._state = 0
+
+        # Sets and calcs are kept in separate namespaces so that clearing
+        # a set value can reveal the calculated one.
+        #
         self._setValue = None
         self._calcedValue = None
 
@@ -541,8 +2028,39 @@ class Node(object):
         directly (via a setValue or overlayValue operation).
 
         """
+        if self._inputs is None:
+            self._inputs = set()
+            self._inputOrder = []
         self._inputs.add(inputNode)
+        self._inputOrder.append(inputNode)
+        if inputNode._height >= self._height:
+            self._raiseHeight(inputNode._height + 1)
 
+    def _raiseHeight(self, height):
+        """Raises the height of this node, and as needed of the nodes
+        downstream of it, so each stays above its inputs.
+
+        """
+        # A node is raised again whenever another path reaches it from
+        # below, so a diamond ends up properly ordered.  A dynamic graph
+        # can briefly hold edges in both directions between two nodes,
+        # until the stale one is reconciled, so the walk is depth-first
+        # and never follows an edge back to a node on its current path.
+        #
+        self._height = height
+        onPath = set([self])
+        stack = [(self, iter(self.outputs))]
+        while stack:
+            node, outputs = stack[-1]
+            for output in outputs:
+                if output._height <= node._height and output not in onPath:
+                    output._height = node._height + 1
+                    onPath.add(output)
+                    stack.append((output, iter(output.outputs)))
+                    break
+            else:
+                stack.pop()
+                onPath.discard(node)
 
     def addOutput(self, outputNode):
         """Informs the node of a new output, that is, a node
@@ -552,7 +2070,28 @@ class Node(object):
         its outputs as well.
 
         """
-        self._outputs.add(outputNode)
+        if self._outputs is None:
+            self._outputs = set()
+        outputs = self._outputs
+        outputs.add(weakref.ref(outputNode))
+
+        # The refs of outputs that have since been collected are pruned
+        # as the outputs are walked, but an input that is read often
+        # and rarely invalidated may never be walked, so they are also
+        # pruned each time the set grows to a power of two.
+        #
+        size = len(outputs)
+        if size >= 8 and not size & (size - 1):
+            self._pruneOutputs()
+
+    def _pruneOutputs(self):
+        """Discards the refs of outputs that have been collected.
+
+        """
+        if self._outputs:
+            dead = [ref for ref in list(self._outputs) if ref() is None]
+            if dead:
+                self._outputs.difference_update(dead)
 
     def removeInput(self, inputNode):
         """Removes the specified node from the list of required
@@ -560,24 +2099,42 @@ class Node(object):
         input.
 
         """
-        if node in self._inputs:
-            self._inputs.remove(inputNode)
+        if self._inputs is not None and inputNode in self._inputs:
+            self._inputs.discard(inputNode)
+            self._inputOrder.remove(inputNode)
 
     def removeOutput(self, outputNode):
         """Removes the output from the list of node outputs, or
         does nothing if the node is not a known output.
 
         """
-        if node in self._outputs:
-            self._outputs.remove(outputNode)
+        if self._outputs is not None:
+            self._outputs.discard(weakref.ref(outputNode))
 
     @property
     def outputs(self):
-        return self._outputs
+        if not self._outputs:
+            return _noNodes
+        # Other threads may add outputs as they evaluate, so iterate
+        # over a copy.
+        #
+        outputs = set()
+        dead = None
+        for ref in list(self._outputs):
+            output = ref()
+            if output is not None:
+                outputs.add(output)
+            elif dead is None:
+                dead = [ref]
+            else:
+                dead.append(ref)
+        if dead:
+            self._outputs.difference_update(dead)
+        return outputs
 
     @property
     def inputs(self):
-        return self._inputs
+        return self._inputs or _noNodes
 
     def getValue(self):
         """Return the node's current value, recalculating if necessary.
@@ -590,14 +2147,35 @@ class Node(object):
         #       how a node was fixed/calced.  Short story: this will
         #       be rewritten.
         #
-        if self.isOverlaid():
-            return self._overlaidValue
         if self.isSet():
             return self._setValue
         if not self.isCalced():
-            self.calcValue()
+            if self._state & _IsStale:
+                self._verifyCalc()
+            if not self.isCalced():
+                self.calcValue()
         return self._calcedValue
 
+    def _verifyCalc(self):
+        """Brings the inputs of a stale node up to date and, if none of
+        them actually changed, revalidates its retained value without
+        recalculating it.
+
+        The inputs are checked in the order the last calculation read
+        them, and an input that changes while being brought up to date
+        marks this node dirty, at which point there is no need to look
+        any further.  So an input is only brought up to date if the
+        inputs read before it are unchanged, in which case the method
+        would read it too, and any exception it raises is the one the
+        recalculation would.
+
+        """
+        for inputNode in list(self._inputOrder or ()):
+            _graph.getValue(inputNode)
+            if self._state & _IsDirty:
+                return
+        self._state = (self._state & ~_IsStale) | _IsCalced
+
     def calcValue(self):
         """(Re)calculates the value of this node my calling
         its underlying method on graph, and updating the
@@ -611,26 +2189,91 @@ class Node(object):
         is not then either the method is not pure or there
         is an issue with the graph.
 
+        The inputs discovered during the calculation replace the
+        previous ones, and the node stops being an output of any
+        input it no longer reads, so the edges always reflect the
+        most recent evaluation.
+
+        A stale or dirty node still holds its previous value.  If the
+        recalculated value is equivalent to it (by the graph method's
+        equality), the nodes that depend on this one are left stale,
+        which lets them revalidate without recalculating.  Otherwise
+        they are marked dirty.
+
+        A node whose inputs are all known statically keeps them, so
+        reading them again costs no edge bookkeeping.
+
+        """
+        retained = self._state & (_IsStale | _IsDirty)
+        previousValue = self._calcedValue
+        previousInputs = self._inputs
+        if not self._state & _IsStatic:
+            self._inputs = self._inputOrder = None
+        try:
+            self._calcedValue = self.graphMethod(self.graphObject, *self.args)
+            self._state = (self._state & ~(_IsStale | _IsDirty)) | _IsCalced
+        finally:
+            if previousInputs and previousInputs is not self._inputs:
+                for inputNode in previousInputs.difference(self.inputs):
+                    inputNode.removeOutput(self)
+        self._notifyStaleOutputs(retained, previousValue)
+
+    def _storeCalc(self, value, inputs):
+        """Stores a value calculated from the given inputs on the
+        node's behalf (within a graph context that does not affect it,
+        say) just as calcValue would have.
+
         """
-        self._calcedValue = self.graphMethod(self.graphObject, *self.args)
-        self._isCalced = True
+        retained = self._state & (_IsStale | _IsDirty)
+        previousValue = self._calcedValue
+        previousInputs = self._inputs
+        if not self._state & _IsStatic:
+            self._inputs = self._inputOrder = None
+        for inputNode in inputs:
+            if self._inputs is None or inputNode not in self._inputs:
+                self.addInput(inputNode)
+                inputNode.addOutput(self)
+        if previousInputs and previousInputs is not self._inputs:
+            for inputNode in previousInputs.difference(self.inputs):
+                inputNode.removeOutput(self)
+        self._calcedValue = value
+        self._state = (self._state & ~(_IsStale | _IsDirty)) | _IsCalced
+        self._notifyStaleOutputs(retained, previousValue)
+
+    def _notifyStaleOutputs(self, retained, previousValue):
+        """Marks the node's stale outputs dirty after a calculation,
+        unless it retained a value equivalent to the new one.
+
+        """
+        if retained and self.graphMethod.equality(previousValue, self._calcedValue):
+            return
+        if self._outputs:
+            for output in self.outputs:
+                if output._state & _IsStale:
+                    output._state = (output._state & ~_IsStale) | _IsDirty
 
     def _invalidateCalc(self):
         """Removes any calculated value, forcing a recalculation
         the next time the node has no set or overlaid value.
 
         """
-        self._invalidateOutputCalcs()
-        self._isCalced = False
-        self._calcedValue = False
+        _invalidateCalcs([self])
 
     def _invalidateOutputCalcs(self):
         """Invalidates any outputs that were dependent on this
         node as part of a calculation.
 
+        Called on every change to a set value, so it also moves the
+        graph to a new revision.
+
         """
-        for output in self._outputs:
-            output._invalidateCalc()
+        _graph._revision = next(_graph._revisions)
+        if self._outputs:
+            deferred = _graph._deferredInvalidations
+            if deferred is not None:
+                deferred.append(self)
+                return
+            _invalidateCalcs(self.outputs)
 
     def setValue(self, value):
         """Sets a specific value on the node.
@@ -643,7 +2286,8 @@ class Node(object):
             raise RuntimeError("You cannot set a read-only node.")
         self._invalidateOutputCalcs()
         self._setValue = value
-        self._isSet = True
+        self._state |= _IsSet
+        _graph._setChanged(self)
 
     def clearSet(self):
         """Clears a previously set value on the node, if
@@ -655,57 +2299,24 @@ class Node(object):
         if not self.isSet():
             return
         self._invalidateOutputCalcs()
-        self._isSet = False
+        self._state &= ~_IsSet
         self._setValue = None
-
-    def overlayValue(self, value):
-        """Overlays the value of the node.  At this level a overlay
-        is merely a value stored in a different namespace that
-        nonetheless invalidates any output nodes.
-
-        """
-        # TODO: Perhaps optimize for _overlaidValue == value case.
-        if not self.graphMethod.isOverlayable():
-            raise RuntimeError("You cannot overlay this node.")
-        self._invalidateOutputCalcs()
-        self._overlaidValue = value
-        self._isOverlaid = True
-
-    def clearOverlay(self):
-        """Clears the current overlay, if any, invalidating
-        outputs if a overlay was actually cleared.
-
-        """
-        if not self.graphMethod.isOverlayable():
-            raise RuntimeError("You cannot overlay this node, so certainly you can't clear any overlay!")
-        if not self.isOverlaid():
-            return
-        self._invalidateOutputCalcs()
-        self._isOverlaid = False
-        self._overlaidValue = None
-
-    def getOverlay(self):
-        """Returns the value of the current overlay, if any, or
-        raises an exception otherwise.
-
-        """
-        if not self.isOverlaid():
-            raise RuntimeError("This node is not overlaid.")
-        return self._overlaidValue
+        _graph._setChanged(self)
 
     def isValid(self):
         """Returns True if the node's value is current.
 
         """
-        return self._isOverlaid or self._isSet or self._isCalced
+        return self._state & (_IsSet | _IsCalced) != 0
 
     def isOverlaid(self):
-        """Returns True if this node is overlaid, False otherwise.
+        """Returns True if this node is overlaid in an active graph
+        context, False otherwise.
 
         Overlays are independent of sets and calcs.
 
         """
-        return self._isOverlaid
+        return _graph.isOverlaid(self)
 
     def isSet(self):
         """Return True if this node was set to an explicit value.
@@ -714,13 +2325,13 @@ class Node(object):
         if its dependencies change.
 
         """
-        return self._isSet
+        return self._state & _IsSet != 0
 
     def isCalced(self):
         """Return True if the value was calculated.
 
         """
-        return self._isCalced
+        return self._state & _IsCalced != 0
 
     def node(self):
         return self
@@ -742,6 +2353,90 @@ class Node(object):
                 self.isCalced()
                 )
 
+_noNodes = frozenset()
+_noValue = object()
+
+def _invalidateCalcs(nodes):
+    """Invalidates the calculated values of the given nodes and of
+    everything downstream of them.
+
+    The walk uses an explicit worklist, so its cost is linear in the
+    size of the affected cone and independent of the depth of the graph.
+    A node whose calculation is already invalid acts as its own visited
+    marker: its outputs were invalidated along with it, so the walk stops
+    there.  A node pinned by a set or overlaid value loses its calculation
+    but its outputs never saw it, so the walk stops there as well.
+
+    With the graph's earlyCutoff enabled, calculated values are
+    retained rather than discarded: the given nodes are marked dirty
+    and everything downstream of them stale.
+
+    """
+    if _graph.earlyCutoff:
+        _markCalcs(nodes)
+        return
+    worklist = list(nodes)
+    while worklist:
+        node = worklist.pop()
+        state = node._state
+        if not state & _IsCalced:
+            continue
+        node._state = state & ~_IsCalced
+        node._calcedValue = None
+        if state & _IsSet or not node._outputs:
+            continue
+        dead = None
+        for ref in node._outputs:
+            output = ref()
+            if output is not None:
+                worklist.append(output)
+            elif dead is None:
+                dead = [ref]
+            else:
+                dead.append(ref)
+        if dead:
+            node._outputs.difference_update(dead)
+
+
+def _markCalcs(nodes):
+    """Marks the given nodes dirty and the nodes downstream of them
+    stale, retaining their calculated values so that a stale node can
+    be revalidated if none of its inputs turns out to have changed.
+
+    Follows the same walk as _invalidateCalcs.
+
+    """
+    worklist = []
+    for node in nodes:
+        state = node._state
+        if not state & (_IsCalced | _IsStale):
+            continue
+        node._state = (state & ~(_IsCalced | _IsStale)) | _IsDirty
+        if state & _IsCalced and not state & _IsSet and node._outputs:
+            worklist.extend(node.outputs)
+    while worklist:
+        node = worklist.pop()
+        state = node._state
+        if not state & _IsCalced:
+            continue
+        node._state = (state & ~_IsCalced) | _IsStale
+        if state & _IsSet or not node._outputs:
+            continue
+        worklist.extend(node.outputs)
+
+def _valuesEqual(value1, value2):
+    """The default equality used by early cutoff.
+
+    Values that cannot be compared to a single truth value (arrays, for
+    example) are treated as different.
+
+    """
+    if value1 is value2:
+        return True
+    try:
+        return bool(value1 == value2)
+    except Exception:
+        return False
 
 class NodeChange(object):
     """Encapsulates a pending change to a node.  Intended to be
@@ -762,6 +2457,138 @@ class NodeChange(object):
         return _graph.lookupNode(self.graphInstanceMethod, self.args, create=True)
 
 
+class NodeFamily(object):
+    """The values of a batched graph method on one object, for every
+    argument it has been called with.
+
+    Rather than a node per argument, the arguments calculated by one
+    vectorized call share a single node, a group, whose value holds
+    each of their values.  The group is an ordinary node: its inputs
+    are whatever the call read, it is invalidated when they change and
+    it is an input of every node that reads one of its arguments.  An
+    argument whose group is invalid is calculated again in a new group,
+    together with the rest of that group's arguments and any other
+    invalid arguments wanted at the same time, so a change to an input
+    costs one call however the arguments are read afterwards.
+    Invalidation is therefore by group rather than by argument.
+
+    A node for an argument is still created when one is needed, to set
+    or overlay it or to evaluate it within a graph context, and from
+    then on the node stands in for the argument.
+
+    """
+    def __init__(self, graphInstanceMethod):
+        self.graphInstanceMethod = graphInstanceMethod
+        self._groups = {}           # Group nodes by argument.
+
+        # A group's args are the tuple of the arguments it calculates,
+        # so a single method calculates them all.
+        #
+        method = graphInstanceMethod.graphMethod.method
+        def calculate(graphObject, arguments):
+            values = method(graphObject, _asArray(list(arguments)))
+            if len(values) != len(arguments):
+                raise RuntimeError("A batched graph method must return a value for each argument.")
+            return dict(zip(arguments, values))
+        self._groupMethod = GraphMethod(calculate, graphInstanceMethod.name)
+
+    def getValue(self, args):
+        """Returns the value for a single argument, given as a tuple.
+
+        """
+        if len(args) != 1:
+            raise TypeError("A batched graph method takes a single argument.")
+        local = _graph._local
+        if local.activeGraphContext is not None or \
+                _graph._lock._writer is not None and _graph._lock._writer != get_ident():
+            return _graph.getValue(self.graphInstanceMethod.node(*args))
+        argument = args[0]
+        group = self._groups.get(argument)
+        if group is None or not group._state & _IsCalced:
+            group = self._calculate([argument], [group])
+        outputNode = local.activeNode
+        if outputNode is not None and (outputNode._inputs is None or group not in outputNode._inputs):
+            outputNode.addInput(group)
+            group.addOutput(outputNode)
+        return group._calcedValue[argument]
+
+    def getValues(self, arguments):
+        """Returns the values for each of the arguments, calculating
+        all of those without a valid value in a single call.
+
+        """
+        graphInstanceMethod = self.graphInstanceMethod
+        local = _graph._local
+        if local.activeGraphContext is not None or \
+                _graph._lock._writer is not None and _graph._lock._writer != get_ident():
+            return _asArray([_graph.getValue(graphInstanceMethod.node(argument)) for argument in arguments])
+        values = []
+        pending = []                # (index, argument) of the arguments to calculate.
+        groups = set()
+        staleGroups = set()
+        for argument in arguments:
+            node = graphInstanceMethod._nodes.get((argument,))
+            if node is not None:
+                values.append(_graph.getValue(node))
+                continue
+            group = self._groups.get(argument)
+            if group is None or not group._state & _IsCalced:
+                pending.append((len(values), argument))
+                values.append(None)
+                staleGroups.add(group)
+                continue
+            values.append(group._calcedValue[argument])
+            groups.add(group)
+        if pending:
+            group = self._calculate([argument for index, argument in pending], staleGroups)
+            for index, argument in pending:
+                values[index] = group._calcedValue[argument]
+            groups.add(group)
+        outputNode = local.activeNode
+        if outputNode is not None:
+            for group in groups:
+                if outputNode._inputs is None or group not in outputNode._inputs:
+                    outputNode.addInput(group)
+                    group.addOutput(outputNode)
+        return _asArray(values)
+
+    def _calculate(self, arguments, staleGroups=()):
+        """Returns a new group holding the values of the arguments,
+        and of the others still in the given stale groups, calculated
+        by a single call to the method.
+
+        """
+        wanted = set(arguments)
+        arguments = list(arguments)
+        for staleGroup in staleGroups:
+            if staleGroup is not None:
+                for argument in staleGroup.args[0]:
+                    if argument not in wanted and self._groups.get(argument) is staleGroup:
+                        wanted.add(argument)
+                        arguments.append(argument)
+        graphInstanceMethod = self.graphInstanceMethod
+        group = Node(graphInstanceMethod.graphObject, self._groupMethod, args=(tuple(arguments),))
+        _graph._evaluate(group)
+        for argument in arguments:
+            self._groups[argument] = group
+        return group
+
+    def _materialize(self, node):
+        """Hands an argument over to its newly created node, which is
+        given the argument's value, if it has one, and the inputs it was
+        calculated from.
+
+        The nodes that read the argument through its group are
+        invalidated, so they read it through the node from now on.
+
+        """
+        group = self._groups.pop(node.args[0], None)
+        if group is None or not group._state & _IsCalced:
+            return
+        node._storeCalc(group._calcedValue[node.args[0]], group.inputs)
+        if group._outputs:
+            _invalidateCalcs(group.outputs)
+
 class GraphInstanceMethod(object):
     """A GraphMethod  bound to an instance of its class.
 
@@ -772,23 +2599,86 @@ class GraphInstanceMethod(object):
     def __init__(self, graphObject, graphMethod):
         self.graphObject = graphObject
         self.graphMethod = graphMethod
+        self._nodes = {}            # Nodes by args, filled in by the graph.
+        self._family = NodeFamily(self) if graphMethod.isBatched() else None
+        self._static = graphObject._staticInputs.get(graphMethod.name)
 
     @property
     def name(self):
         return self.graphMethod.name
 
     def node(self, *args):
-        return _graph.lookupNode(self, args, create=True)
-
-    def __call__(self, *args):
-        return self.getValue(*args)
+        node = self._nodes.get(args)
+        if node is None:
+            node = _graph.lookupNode(self, args, create=True)
+            if self._family is not None:
+                self._family._materialize(node)
+        return node
 
     def getValue(self, *args):
         """Returns the current value of underlying node based on the current
         graph state.
 
         """
-        return _graph.getValue(self.node(*args))
+        # This is the hot path of the graph, so reading an already valid
+        # node is inlined here: a probe of the node table, an edge check
+        # that is skipped once the edge is known, and direct flag tests.
+        # Everything else falls through to the graph.
+        #
+        node = self._nodes.get(args)
+        if node is None:
+            if self._family is not None:
+                return self._family.getValue(args)
+            node = _graph.lookupNode(self, args, create=True)
+        local = _graph._local
+        outputNode = local.activeNode
+        if outputNode is not None:
+            if outputNode._inputs is None or node not in outputNode._inputs:
+                outputNode.addInput(node)
+                node.addOutput(outputNode)
+        elif local.activeGraphContext is not None:
+            return _graph.getValue(node)
+        else:
+            # A top-level read takes no lock, so a write may change the
+            # node's state and value as they are read.  If the lock's
+            # generation shows one did (or is under way), the read is
+            # retried under the lock.
+            #
+            lock = _graph._lock
+            generation = lock._generation
+            if generation & 1:
+                return _graph.getValue(node)
+            state = node._state
+            if state & _IsSet:
+                value = node._setValue
+            elif state & _IsCalced:
+                value = node._calcedValue
+            else:
+                return _graph._evaluate(node)
+            if lock._generation != generation:
+                return _graph.getValue(node)
+            return value
+        state = node._state
+        if state & _IsSet:
+            return node._setValue
+        if state & _IsCalced:
+            return node._calcedValue
+        return _graph._evaluate(node)
+
+    __call__ = getValue
+
+    def getValues(self, arguments):
+        """Returns the values of a method taking a single argument for
+        each of the given arguments, as a NumPy array (or, if NumPy isn't
+        installed, a list).
+
+        A batched method calculates all of the arguments without a
+        valid value in a single call.
+
+        """
+        if self._family is not None:
+            return self._family.getValues(arguments)
+        return _asArray([self.getValue(argument) for argument in arguments])
 
     def setValue(self, value, *args):
         # TODO: Is this the right place for delegation, or should
@@ -802,8 +2692,7 @@ class GraphInstanceMethod(object):
         #
         if self.graphMethod.delegatesChanges():
             nodeChanges = self.graphMethod.delegateTo(self.graphObject, value, *args)
-            for nodeChange in nodeChanges:
-                _graph.setValue(nodeChange.node, nodeChange.value)
+            _graph.applyChanges(nodeChanges)
             return
         _graph.setValue(self.node(*args), value)
 
@@ -817,14 +2706,97 @@ class GraphInstanceMethod(object):
         _graph.clearOverlay(self.node(*args))
 
     def isSet(self, *args):
+        if self._family is not None and args not in self._nodes:
+            return False
         return self.node(*args).isSet()
 
     def isOverlaid(self, *args):
-        return self.node(*args).isOverlaid()
+        if self._family is not None and args not in self._nodes:
+            return False
+        return _graph.isOverlaid(self.node(*args))
+
+# The inputs of a graph method found by reading its source: the
+# (name, args) of each self.Name(...) call with literal arguments, whether
+# those are all the graph reads the method makes, and whether the method
+# takes arguments.
+#
+_StaticInputs = collections.namedtuple('_StaticInputs', 'inputs complete takesArgs')
+
+# Parsed method definitions, by method.
+#
+_parsedMethods = weakref.WeakKeyDictionary()
+
+def _parseMethod(method):
+    """Returns (function, selfName): the ast of a method's definition
+    and the name of its first argument, or None if its source can't be
+    read.  The ast is shared, so must not be modified.
+
+    """
+    if method in _parsedMethods:
+        return _parsedMethods[method]
+    parsed = None
+    try:
+        function = ast.parse(textwrap.dedent(inspect.getsource(method))).body[0]
+        if isinstance(function, ast.FunctionDef) and function.args.args:
+            selfArg = function.args.args[0]
+            parsed = function, getattr(selfArg, 'arg', None) or getattr(selfArg, 'id', None)
+    except (IOError, TypeError, SyntaxError, IndexError):
+        pass
+    _parsedMethods[method] = parsed
+    return parsed
+
+def _discoverInputs(method, graphMethodNames):
+    """Returns the _StaticInputs of a method, or None if its source
+    can't be read.
+
+    The inputs are complete if the method makes no other use of self
+    and calls no other methods, since either may read the graph.
+
+    """
+    parsed = _parseMethod(method)
+    if parsed is None:
+        return None
+    function, selfName = parsed
+    inputs = []
+    staticSelves = set()
+    complete = True
+    for statement in function.body:
+        for node in ast.walk(statement):
+            if not isinstance(node, ast.Call):
+                continue
+            func = node.func
+            if isinstance(func, ast.Name):
+                continue
+            if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and \
+                    func.value.id == selfName and func.attr in graphMethodNames and \
+                    not node.keywords and not getattr(node, 'starargs', None) and \
+                    not getattr(node, 'kwargs', None):
+                try:
+                    args = tuple(ast.literal_eval(arg) for arg in node.args)
+                except ValueError:
+                    complete = False
+                    continue
+                if (func.attr, args) not in inputs:
+                    inputs.append((func.attr, args))
+                staticSelves.add(func.value)
+                continue
+            complete = False
+    for statement in function.body:
+        for node in ast.walk(statement):
+            if isinstance(node, ast.Name) and node.id == selfName and node not in staticSelves:
+                complete = False
+    takesArgs = len(function.args.args) > 1 or bool(function.args.vararg)
+    return _StaticInputs(tuple(inputs), complete, takesArgs)
 
 class GraphType(type):
     """Metaclass responsible for creating on-graph objects.
 
+    If the class sets staticDiscovery, the source of each of its graph
+    methods is read for the calls it makes to the others, with literal
+    arguments, so their nodes are wired to those inputs when they are
+    created rather than when they are first calculated.  Inputs the
+    source doesn't reveal are still discovered as the methods run.
+
     """
     def __init__(cls, name, bases, attrs):
         for k,v in attrs.items():
@@ -845,31 +2817,103 @@ class GraphType(type):
             if isinstance(v, GraphMethod):
                 graphMethods.append(v)
         cls._graphMethods = graphMethods
+        cls._graphMethodNames = frozenset(graphMethod.name for graphMethod in graphMethods)
         cls._savedGraphMethods = [graphMethod for graphMethod in graphMethods if graphMethod.isSaved()]
 
+        cls._staticInputs = {}
+        if getattr(cls, 'staticDiscovery', False):
+            names = set(graphMethod.name for graphMethod in graphMethods if not graphMethod.isBatched())
+            for graphMethod in graphMethods:
+                static = _discoverInputs(graphMethod.method, names)
+                if static is not None:
+                    cls._staticInputs[graphMethod.name] = static
+
 class GraphObject(object):
     """A graph-enabled object.
 
     """
     __metaclass__ = GraphType
 
+    # Set in a subclass to discover the inputs of its graph methods from
+    # their source; see GraphType.
+    #
+    staticDiscovery = False
+
     def __setattr__(self, name, value):
-        v = getattr(self, name)
-        if isinstance(v, GraphInstanceMethod):
-            v.setValue(value)
+        if name in self._graphMethodNames:
+            getattr(self, name).setValue(value)
             return
         object.__setattr__(self, name, value)
 
     def __init__(self, **kwargs):
-        for k in dir(self):
-            v = getattr(self, k)
-            if isinstance(v, GraphMethod):
-                object.__setattr__(self, k, GraphInstanceMethod(self, getattr(self,k)))
+        # Graph methods are bound as they are first used (see
+        # GraphMethod.__get__), so an object costs nothing up front.
+        #
+        for name, static in self._staticInputs.items():
+            if not static.takesArgs:
+                getattr(self, name).node()
         for k,v in kwargs.items():
-            attr = getattr(self, k)
-            if not isinstance(attr, GraphInstanceMethod):
+            if k not in self._graphMethodNames:
                 raise RuntimeError("Not a GraphInstanceMethod: %s" % k)
-            self.__setattr__(attr.graphMethod.name, v)
+            getattr(self, k).setValue(v)
+
+    @classmethod
+    def fromColumns(cls, columns, count=None):
+        """Creates a list of objects from columns of values for their
+        settable methods, given as a dictionary of equal-length lists
+        (or NumPy arrays) by method name.  count, the number of objects,
+        is needed only if there are no columns.
+
+        This is equivalent to, but much faster than
+
+            [cls(**dict((name, column[i]) for name, column in columns.items()))
+             for i in range(count)]
+
+        since the objects' set values are written directly.
+
+        """
+        columns = dict((name, values.tolist() if hasattr(values, 'tolist') else list(values))
+                       for name, values in columns.items())
+        counts = set(len(values) for values in columns.values())
+        if count is not None:
+            counts.add(count)
+        if len(counts) > 1:
+            raise ValueError("Columns of different lengths: %s" % sorted(counts))
+        with _gcPaused():
+            graphObjects = [cls() for i in range(counts.pop() if counts else 0)]
+            cls._setColumns(graphObjects, columns)
+        return graphObjects
+
+    @classmethod
+    def fromRecords(cls, records):
+        """Creates a list of objects from an iterable of records, each a
+        dictionary of values for the settable methods of one object by
+        method name.  See fromColumns().
+
+        """
+        graphObjects = []
+        columns = {}
+        with _gcPaused():
+            for record in records:
+                graphObject = cls()
+                for name, value in record.items():
+                    column = columns.get(name)
+                    if column is None:
+                        column = columns[name] = ([], [])
+                    column[0].append(graphObject)
+                    column[1].append(value)
+                graphObjects.append(graphObject)
+            for name, (columnObjects, values) in columns.items():
+                cls._setColumns(columnObjects, {name: values})
+        return graphObjects
+
+    @classmethod
+    def _setColumns(cls, graphObjects, columns):
+        for name in columns:
+            if name not in cls._graphMethodNames:
+                raise RuntimeError("Not a GraphInstanceMethod: %s" % name)
+        for name, values in columns.items():
+            _graph._setNewObjects(getattr(cls, name), graphObjects, values)
 
     def toDict(self):
         """Returns a dictionary of name/value pairs for all saved methods.
@@ -878,7 +2922,79 @@ class GraphObject(object):
         # TODO: Flesh this out a bit: deep toDict, including settable nodes, perhaps, etc.
         return dict([(k.name, getattr(self, k.name)()) for k in self._savedGraphMethods])
 
-def graphMethod(funcOrFlags=0, delegateTo=None):
+    @classmethod
+    def toColumns(cls, graphObjects, batchSize=10000, asArray=False):
+        """Generates the values of the saved methods of objects of the
+        class, a batch of objects at a time, as dictionaries of lists of
+        values by method name (or, if asArray is True, NumPy arrays, if
+        NumPy is installed).
+
+        Each batch holds the values toDict() would return for each of
+        batchSize objects, but values that are already known are read
+        directly from the nodes.
+
+        """
+        names = [graphMethod.name for graphMethod in cls._savedGraphMethods]
+        graphObjects = iter(graphObjects)
+        while True:
+            batch = list(itertools.islice(graphObjects, batchSize))
+            if not batch:
+                return
+            columns = dict((name, cls._savedValues(batch, name)) for name in names)
+            if asArray:
+                columns = dict((name, _asArray(values)) for name, values in columns.items())
+            yield columns
+
+    @classmethod
+    def toJSONLines(cls, graphObjects, batchSize=10000):
+        """Generates a line of JSON (without the newline) holding the
+        values of the saved methods of each of the objects of the class,
+        as toDict() would return them.
+
+        """
+        # The keys are the same on every line, so only the values are
+        # encoded for each object.
+        #
+        encode = json.JSONEncoder().encode
+        names = sorted(graphMethod.name for graphMethod in cls._savedGraphMethods)
+        keys = [encode(name) + ': ' for name in names]
+        if not names:
+            for graphObject in graphObjects:
+                yield '{}'
+            return
+        for columns in cls.toColumns(graphObjects, batchSize):
+            for values in zip(*[columns[name] for name in names]):
+                yield '{' + ', '.join([key + encode(value) for key, value in zip(keys, values)]) + '}'
+
+    @classmethod
+    def _savedValues(cls, graphObjects, name):
+        """Returns the values of a method taking no arguments for each of
+        the objects.
+
+        """
+        graphMethod = getattr(cls, name)
+        local = _graph._local
+        direct = local.activeNode is None and local.activeGraphContext is None and \
+                (_graph._lock._writer is None or _graph._lock._writer == get_ident())
+        values = []
+        for graphObject in graphObjects:
+            if not isinstance(graphObject, cls):
+                raise TypeError("%r is not a %s." % (graphObject, cls.__name__))
+            graphInstanceMethod = graphObject.__dict__.get(name) or graphMethod.__get__(graphObject)
+            if direct:
+                node = graphInstanceMethod._nodes.get(())
+                if node is not None:
+                    state = node._state
+                    if state & _IsSet:
+                        values.append(node._setValue)
+                        continue
+                    if state & _IsCalced:
+                        values.append(node._calcedValue)
+                        continue
+            values.append(graphInstanceMethod.getValue())
+        return values
+
+def graphMethod(funcOrFlags=0, delegateTo=None, equality=None, batched=False):
     """Declare a GraphObject method as on-graph.
 
     Use as a decorator, for example:
@@ -893,18 +3009,545 @@ def graphMethod(funcOrFlags=0, delegateTo=None):
             def Y(self):
                 return ...
 
+            @graphMethod(batched=True)
+            def Z(self, values):
+                return values * self.X()
+
     """
     if type(funcOrFlags) == types.FunctionType:
         return GraphMethod(funcOrFlags, funcOrFlags.__name__)
     def wrap(f):
-        return GraphMethod(f, f.__name__, funcOrFlags, delegateTo=delegateTo)
+        return GraphMethod(f, f.__name__, funcOrFlags, delegateTo=delegateTo, equality=equality, batched=batched)
     return wrap
 
+class _Unseen(Exception):
+    """Raised by compiled code that reaches a read its graph never saw."""
+
+def _unseen():
+    raise _Unseen()
+
+def _param(name):
+    """Returns the ast of a function parameter."""
+    if hasattr(ast, 'arg'):
+        return ast.arg(arg=name, annotation=None)
+    return ast.Name(id=name, ctx=ast.Param())
+
+class _ReadInliner(ast.NodeTransformer):
+    """Rewrites the definition of a node's method so that each read of
+    one of the node's inputs, self.Name(...), is a parameter instead.
+
+    A read whose arguments can be worked out from the node's own does
+    the same, but of an input the node didn't read when it was last
+    calculated, calls _unseen().  Any other use of self is a problem.
+
+    """
+    def __init__(self, node, selfName, params, names):
+        self.node = node
+        self.selfName = selfName
+        self.params = params        # The node's arguments, by parameter name.
+        self.names = names          # The names of the object's graph methods.
+        self.inputs = []            # The inputs read, in parameter order.
+        self.problem = None
+
+    def visit_Call(self, call):
+        func = call.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and \
+                func.value.id == self.selfName and func.attr in self.names:
+            args = self._evaluateArgs(call)
+            if args is not None:
+                inputNode = getattr(self.node.graphObject, func.attr)._nodes.get(args)
+                if inputNode is not None and inputNode in self.node.inputs:
+                    if inputNode not in self.inputs:
+                        self.inputs.append(inputNode)
+                    name = ast.Name(id='_input%d' % self.inputs.index(inputNode), ctx=ast.Load())
+                    return ast.copy_location(name, call)
+                unseen = ast.Call(func=ast.Name(id='_unseen', ctx=ast.Load()), args=[], keywords=[])
+                if 'starargs' in ast.Call._fields:
+                    unseen.starargs = unseen.kwargs = None
+                return ast.copy_location(unseen, call)
+        return self.generic_visit(call)
+
+    def visit_Name(self, name):
+        if name.id == self.selfName:
+            self.problem = 'it uses %s other than to call its graph methods' % self.selfName
+        return name
+
+    def _evaluateArgs(self, call):
+        """Returns the arguments of a call, if they depend only on the
+        node's own arguments, or None.
+
+        """
+        if call.keywords or getattr(call, 'starargs', None) or getattr(call, 'kwargs', None):
+            return None
+        args = []
+        for arg in call.args:
+            names = set(node.id for node in ast.walk(arg) if isinstance(node, ast.Name))
+            if not names.issubset(self.params) or any(isinstance(node, ast.Call) for node in ast.walk(arg)):
+                return None
+            expression = ast.fix_missing_locations(ast.Expression(body=arg))
+            args.append(eval(compile(expression, '<args>', 'eval'), {}, self.params))
+        return tuple(args)
+
+def _inlineReads(node, dependent):
+    """Returns (function, inputs): a function equivalent to the node's
+    method that takes the values of the inputs it reads as parameters,
+    after a function raising _Unseen and before the node's arguments.
+
+    Raises a RuntimeError if the method can't be rewritten so, or if it
+    would read any of the dependent nodes other than as a parameter.
+
+    """
+    method = node.graphMethod.method
+    parsed = _parseMethod(method)
+    if parsed is None:
+        raise RuntimeError("%s cannot be compiled: its source is not available." % node)
+    function, selfName = copy.deepcopy(parsed[0]), parsed[1]
+    paramNames = [getattr(arg, 'arg', None) or getattr(arg, 'id', None) for arg in function.args.args[1:]]
+    if function.args.vararg or function.args.kwarg or method.__closure__ or len(paramNames) != len(node.args):
+        raise RuntimeError("%s cannot be compiled: only plain functions with positional arguments can be." % node)
+    names = set(graphMethod.name for graphMethod in node.graphObject._graphMethods if not graphMethod.isBatched())
+    inliner = _ReadInliner(node, selfName, dict(zip(paramNames, node.args)), names)
+    function.body = [inliner.visit(statement) for statement in function.body]
+    if inliner.problem is None:
+        for inputNode in node.inputs:
+            if inputNode in dependent and inputNode not in inliner.inputs:
+                inliner.problem = 'it reads %s other than through %s' % (inputNode, selfName)
+    if inliner.problem is not None:
+        raise RuntimeError("%s cannot be compiled: %s." % (node, inliner.problem))
+    function.name = '_compiledMethod'
+    function.decorator_list = []
+    function.args.args = [_param(name) for name in
+                          ['_unseen'] + ['_input%d' % i for i in range(len(inliner.inputs))] + paramNames]
+    function.args.defaults = []
+    module = ast.Module(body=[function])
+    if 'type_ignores' in ast.Module._fields:
+        module.type_ignores = []
+    namespace = {}
+    exec(compile(ast.fix_missing_locations(module), inspect.getsourcefile(method) or '<compiled>', 'exec'),
+         method.__globals__, namespace)
+    return namespace['_compiledMethod'], inliner.inputs
+
+class CompiledGraph(object):
+    """A function of the values of some leaf nodes that returns the
+    value of a root node as if the leaves were overlaid with them, made
+    by Graph.compile().
+
+    The nodes between the leaves and the root, as discovered by
+    evaluating the root, are evaluated in topological order by straight-
+    line code that passes values in local variables, with each node's
+    reads of its inputs rewritten as parameters.  Nodes that don't
+    depend on the leaves are evaluated once, when compiling.
+
+    A calculation that reaches a read its node didn't make when the
+    graph was discovered (a branch never taken, say), or a call made
+    within a graph context, falls back to evaluating the graph, with
+    the leaves overlaid in a context of its own.  Any set on the graph
+    compiles the function again on its next call.
+
+    """
+    def __init__(self, graph, rootNode, leaves=None):
+        self.graph = graph
+        self.rootNode = rootNode
+        self.leaves = leaves
+        self.fallbacks = 0          # The number of calls that fell back to the graph.
+        self._compile()
+
+    def _compile(self):
+        graph = self.graph
+        rootNode = self.rootNode
+        graph.getValue(rootNode)
+        self._revision = graph._revision
+
+        # Discover the graph below the root, stopping at the leaves and
+        # at set nodes, in post-order (each node after its inputs), and
+        # find the nodes that depend on the leaves.  The order follows
+        # the edges themselves rather than the nodes' heights, which
+        # only bound it.
+        #
+        leaves = self.leaves
+        stops = set(leaves) if leaves is not None else ()
+        def below(node):
+            if node in stops or node.isSet():
+                return iter(())
+            return iter(list(node.inputs))
+        order = []
+        visited = set([rootNode])
+        stack = [(rootNode, below(rootNode))]
+        while stack:
+            node, inputs = stack[-1]
+            for inputNode in inputs:
+                if inputNode not in visited:
+                    visited.add(inputNode)
+                    stack.append((inputNode, below(inputNode)))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        if leaves is None:
+            leaves = [node for node in order if not node.inputs and node.graphMethod.isSettable()]
+            leaves.sort(key=lambda node: (node.graphMethod.name, repr(node.args), id(node.graphObject)))
+            self.leaves = leaves
+        dependent = set(leaves)
+        for node in order:
+            if node not in dependent and not node.isSet() and dependent.intersection(node.inputs):
+                dependent.add(node)
+
+        # Generate the code.
+        #
+        names = {}
+        namespace = {'_unseen': _unseen}
+        for index, leaf in enumerate(leaves):
+            names[leaf] = '_leaf%d' % index
+        lines = []
+        compiled = [node for node in order if node in dependent and node not in leaves]
+        for index, node in enumerate(compiled):
+            function, inputs = _inlineReads(node, dependent)
+            namespace['_method%d' % index] = function
+            args = ['_unseen']
+            for inputNode in inputs:
+                if inputNode not in names:
+                    names[inputNode] = '_constant%d' % len(namespace)
+                    namespace[names[inputNode]] = inputNode.getValue()
+                args.append(names[inputNode])
+            for position, arg in enumerate(node.args):
+                namespace['_arg%d_%d' % (index, position)] = arg
+                args.append('_arg%d_%d' % (index, position))
+            names[node] = '_value%d' % index
+            lines.append('    _value%d = _method%d(%s)' % (index, index, ', '.join(args)))
+        if rootNode not in names:
+            names[rootNode] = '_root'
+            namespace['_root'] = rootNode.getValue()
+        source = 'def _compiled(%s):\n%s\n    return %s\n' % (
+                ', '.join(names[leaf] for leaf in leaves), '\n'.join(lines), names[rootNode])
+        exec(compile(source, '<compiled %s>' % rootNode, 'exec'), namespace)
+        self._function = namespace['_compiled']
+
+    def __call__(self, *values):
+        """Returns the root's value with the leaves overlaid with the
+        given values, in the order of the leaves attribute.
+
+        """
+        if len(values) != len(self.leaves):
+            raise TypeError("Expected %d leaf values, got %d." % (len(self.leaves), len(values)))
+        graph = self.graph
+        if graph.activeGraphContext is None:
+            if graph._revision != self._revision:
+                self._compile()
+            try:
+                return self._function(*values)
+            except _Unseen:
+                pass
+        self.fallbacks += 1
+        with GraphContext(graph=graph) as graphContext:
+            for leaf, value in zip(self.leaves, values):
+                graphContext.overlayValue(leaf, value)
+            return graph.getValue(self.rootNode)
+
+# The layout of a snapshot file: a header, the records of the nodes,
+# and an open-addressed hash table of (key hash, record offset), with
+# an offset of 0 marking an empty slot.  A record is a header followed
+# by the node's key, its pickled set and calced values (either may be
+# empty) and the offsets of its inputs' records.
+#
+_snapshotMagic = b'NODESNP1'
+_snapshotHeader = struct.Struct('<8sQQ')        # Magic, table size, table offset.
+_snapshotRecord = struct.Struct('<IBIII')       # Key, flags, set, calc and input lengths.
+_snapshotEntry = struct.Struct('<QQ')           # Key hash, record offset.
+_SnapshotSet = 0x1
+_SnapshotCalced = 0x2
+
+_missing = object()
+
+def _snapshotKey(id, name, args):
+    """Returns the key of a node in a snapshot: the id of its object in
+    a store, its method's name and its pickled arguments.
+
+    """
+    return id.encode('utf-8') + b'\0' + name.encode('utf-8') + b'\0' + args
+
+def _snapshotHash(key):
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+def _writeSnapshot(graph, path, store):
+    """Writes the snapshot of the graph's nodes taken by
+    Graph.snapshot() and returns the number of nodes written.
+
+    """
+    records = collections.OrderedDict()     # (key, flags, set, calc, inputs) by node.
+    for node in sorted(list(graph.nodes.values()), key=lambda node: node._height):
+        id = store.idOf(node.graphObject)
+        if id is None:
+            continue
+        state = node._state
+        try:
+            key = _snapshotKey(id, node.graphMethod.name, store.dumps(node.args, add=False))
+        except Exception:
+            continue
+        flags, setData, calcData = 0, b'', b''
+        if state & _IsSet:
+            try:
+                setData = store.dumps(node._setValue, add=False)
+                flags |= _SnapshotSet
+            except Exception:
+                pass
+
+        # A calced value is only worth keeping if it is known to be up to
+        # date and so are all of its inputs.
+        #
+        inputs = list(node.inputs)
+        if state & _IsCalced and not state & (_IsStale | _IsDirty) and \
+                all(inputNode in records for inputNode in inputs):
+            try:
+                calcData = store.dumps(node._calcedValue, add=False)
+                flags |= _SnapshotCalced
+            except Exception:
+                pass
+        if flags:
+            records[node] = (key, flags, setData, calcData, inputs if flags & _SnapshotCalced else [])
+
+    offsets = {}
+    offset = _snapshotHeader.size
+    for node, (key, flags, setData, calcData, inputs) in records.items():
+        offsets[node] = offset
+        offset += _snapshotRecord.size + len(key) + len(setData) + len(calcData) + 8 * len(inputs)
+    size = 1
+    while size < 2 * len(records):
+        size *= 2
+    table = [(0, 0)] * size
+    for node, record in records.items():
+        h = _snapshotHash(record[0])
+        slot = h & (size - 1)
+        while table[slot][1]:
+            slot = (slot + 1) & (size - 1)
+        table[slot] = (h, offsets[node])
+
+    temporaryPath = path + '.tmp'
+    with open(temporaryPath, 'wb') as output:
+        output.write(_snapshotHeader.pack(_snapshotMagic, size, offset))
+        for node, (key, flags, setData, calcData, inputs) in records.items():
+            output.write(_snapshotRecord.pack(len(key), flags, len(setData), len(calcData), len(inputs)))
+            output.write(key)
+            output.write(setData)
+            output.write(calcData)
+            output.write(struct.pack('<%dQ' % len(inputs), *[offsets[inputNode] for inputNode in inputs]))
+        for entry in table:
+            output.write(_snapshotEntry.pack(*entry))
+    os.rename(temporaryPath, path)
+    return len(records)
+
+class _Snapshot(object):
+    """A snapshot restored by Graph.restore(), which seeds the nodes of
+    the graph from a memory-mapped file as they are created.
+
+    A node is seeded once, if it has no value of its own: a set value
+    is restored unless the node is Saved (in which case the store is
+    the authority), and a calced value is restored, along with its
+    edges, if the values of all of its inputs are those they had when
+    the snapshot was taken.  Inputs are seeded first, as needed.
+
+    """
+    def __init__(self, graph, path, store):
+        self._graph = graph
+        self._store = store
+        with open(path, 'rb') as snapshotFile:
+            self._map = mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._size, self._table = _snapshotHeader.unpack_from(self._map, 0)
+        if magic != _snapshotMagic:
+            self._map.close()
+            raise ValueError("%s is not a graph snapshot." % path)
+        self._attempted = weakref.WeakKeyDictionary()   # Nodes seen, and the calced values restored.
+
+    def close(self):
+        self._map.close()
+
+    def materialize(self, node):
+        """Seeds the node from the snapshot, if it has a record there
+        and hasn't been seeded (or tried to be) already.
+
+        """
+        if node in self._attempted:
+            return
+        self._attempted[node] = _missing
+        id = self._store.idOf(node.graphObject)
+        if id is None:
+            return
+        try:
+            key = _snapshotKey(id, node.graphMethod.name, self._store.dumps(node.args, add=False))
+        except Exception:
+            return
+        offset = self._find(key)
+        if offset is not None:
+            self._seed(node, offset)
+
+    def _seed(self, node, offset):
+        key, flags, setData, calcData, inputOffsets = self._record(offset)
+        graphMethod = node.graphMethod
+        try:
+            if flags & _SnapshotSet and not node._state & _IsSet and \
+                    graphMethod.isSettable() and not graphMethod.isSaved():
+                node._setValue = self._store.loads(setData, load=False)
+                node._state |= _IsSet
+            if not flags & _SnapshotCalced or node._state & (_IsCalced | _IsStale | _IsDirty):
+                return
+            inputs = []
+            for inputOffset in inputOffsets:
+                inputNode = self._nodeAt(inputOffset)
+                if inputNode is None or not self._matches(inputNode, inputOffset):
+                    return
+                inputs.append(inputNode)
+            value = self._store.loads(calcData, load=False)
+        except Exception:
+            return
+        node._storeCalc(value, inputs)
+        self._attempted[node] = value
+
+    def _nodeAt(self, offset):
+        """Returns the node recorded at the offset, seeded, or None if
+        its object isn't loaded.
+
+        """
+        key = self._record(offset)[0]
+        id, name, args = key.split(b'\0', 2)
+        graphObject = self._store.get(id.decode('utf-8'), load=not self._graph.isComputing())
+        if graphObject is None:
+            return None
+        graphInstanceMethod = getattr(graphObject, name.decode('utf-8'))
+        node = self._graph.lookupNode(graphInstanceMethod, self._store.loads(args, load=False))
+        self.materialize(node)
+        return node
+
+    def _matches(self, node, offset):
+        """Returns True if the node has the value recorded at the
+        offset.
+
+        """
+        key, flags, setData, calcData, inputOffsets = self._record(offset)
+        state = node._state
+        if flags & _SnapshotSet:
+            return bool(state & _IsSet) and \
+                    node.graphMethod.equality(node._setValue, self._store.loads(setData, load=False))
+        if state & _IsSet or not state & _IsCalced or state & (_IsStale | _IsDirty):
+            return False
+        if self._attempted.get(node, _missing) is node._calcedValue:
+            return True
+        return node.graphMethod.equality(node._calcedValue, self._store.loads(calcData, load=False))
+
+    def _find(self, key):
+        """Returns the offset of the record with the given key, or None.
+
+        """
+        h = _snapshotHash(key)
+        mask = self._size - 1
+        slot = h & mask
+        while True:
+            entryHash, offset = _snapshotEntry.unpack_from(self._map, self._table + slot * _snapshotEntry.size)
+            if not offset:
+                return None
+            if entryHash == h and self._record(offset)[0] == key:
+                return offset
+            slot = (slot + 1) & mask
+
+    def _record(self, offset):
+        """Returns (key, flags, set, calc, inputs) for the record at the
+        offset, where inputs are the offsets of the inputs' records.
+
+        """
+        keyLength, flags, setLength, calcLength, inputCount = _snapshotRecord.unpack_from(self._map, offset)
+        start = offset + _snapshotRecord.size
+        key = self._map[start:start + keyLength]
+        start += keyLength
+        setData = self._map[start:start + setLength]
+        start += setLength
+        calcData = self._map[start:start + calcLength]
+        start += calcLength
+        inputs = struct.unpack_from('<%dQ' % inputCount, self._map, start)
+        return key, flags, setData, calcData, inputs
+
 _graph = Graph()
 
-# TODO: Add a node garbage collector (perhaps weakref).
-# TODO: Add multithreading support.
-# TODO: Add database storage support.
+class _gcPaused(object):
+    """Pauses the cyclic garbage collector, which would otherwise run
+    over and over as a great many objects are created at once.
+
+    The collector is shared by every thread, so pauses nest across
+    threads: it is paused by the first to begin and restored to the
+    state it was in then by the last to end.
+
+    """
+    _lock = threading.Lock()
+    _depth = 0
+    _enabled = False
+
+    def __enter__(self):
+        cls = _gcPaused
+        with cls._lock:
+            if not cls._depth:
+                cls._enabled = gc.isenabled()
+                gc.disable()
+            cls._depth += 1
+
+    def __exit__(self, *args):
+        cls = _gcPaused
+        with cls._lock:
+            cls._depth -= 1
+            if not cls._depth and cls._enabled:
+                gc.enable()
+
+def getGraph():
+    """Returns the graph on which all GraphObjects live.
+
+    """
+    return _graph
+
+def _asArray(values):
+    """Returns the values as a NumPy array or, if NumPy isn't
+    installed, a list.
+
+    """
+    if numpy is None:
+        return list(values)
+    return numpy.asarray(values)
+
+def _asNode(nodeOrMethod):
+    """Returns the node given directly or by a GraphInstanceMethod
+    that takes no arguments.
+
+    """
+    if isinstance(nodeOrMethod, GraphInstanceMethod):
+        return nodeOrMethod.node()
+    return nodeOrMethod
+
+# The scenarios a worker process evaluates, as (graph, scenarios, targets).
+#
+_scenarioJob = None
+
+def _initScenarioWorker(graph, scenarios, targets):
+    """Prepares a worker process forked by GraphContext.evaluateScenarios.
+
+    The forked graph lock still belongs to the parent's thread, so
+    the worker gets one of its own.
+
+    """
+    global _scenarioJob
+    _scenarioJob = (graph, scenarios, targets)
+    graph._lock = _ReadWriteLock()
+    graph._computed = threading.Condition(threading.Lock())
+
+def _evaluateScenario(index, job=None):
+    """Returns (index, values): the values of the targets under the
+    scenario with the given index.
+
+    """
+    graph, scenarios, targets = job or _scenarioJob
+    scenario = scenarios[index]
+    if not isinstance(scenario, GraphContext):
+        overlays = scenario
+        scenario = GraphContext(graph=graph)
+        for node, value in overlays.items():
+            scenario.addOverlay(_asNode(node), value)
+    with scenario:
+        return index, [graph.getValue(node) for node in targets]
+
 # TODO: Add subscriptions.
 # TODO: Productionize for large-scale use (perhaps with CPython).
 # TODO: Integrate with AMPS.
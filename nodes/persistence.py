@@ -0,0 +1,387 @@
+"""nodes.persistence: Storage for the saved values of graph objects.
+
+A Store holds the set values of the Saved nodes of the GraphObjects
+added to it, so that a program can read objects back rather than build
+them again each time it is launched:
+
+    store = SQLiteStore('objects.db')
+    id = store.add(o)
+    o.X = ...
+    store.commit()
+
+    ...
+
+    o = SQLiteStore('objects.db').get(id)
+
+"""
+import importlib
+import io
+import sqlite3
+import threading
+import uuid
+import weakref
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+from .nodes import GraphObject, getGraph
+
+class Store(object):
+    """A collection of persistent GraphObjects, identified by id.
+
+    The store listens to the graph for changes to the set values of the
+    Saved nodes of its objects, and commit() writes just those nodes'
+    values.  Only set values are saved: a saved node that isn't set
+    is calculated from its method, as usual, and clearing a set removes
+    its saved value.
+
+    Objects are read back by id, one at a time or in bulk, and only when
+    asked for; an object that is already loaded is returned as is.
+    Values are pickled, except that GraphObjects they refer to are saved
+    (adding them to the store, if need be) and referred to by id.
+
+    A Store is abstract: a subclass implements the storage backend,
+    which deals only in ids, class names and pickled bytes, by
+    overriding read(), write(), delete() and keys().
+
+    """
+    def __init__(self, graph=None):
+        self._graph = graph or getGraph()
+        self._lock = threading.RLock()
+        self._loaded = threading.Condition(self._lock)  # Notified as loads finish.
+        self._loading = {}          # The idents of the threads loading objects, by id.
+        self._objects = weakref.WeakValueDictionary()   # Objects by id.
+        self._ids = weakref.WeakKeyDictionary()         # Ids by object, once loaded.
+        self._new = {}              # Objects added since the last commit, by id.
+        self._dirty = {}            # Nodes changed since the last commit, by (id, name, args).
+        self._graph.addListener(self._nodeChanged)
+
+    def add(self, graphObject, id=None):
+        """Adds an object to the store, to be saved on the next commit,
+        and returns its id.  An object already in the store keeps the
+        id it has.
+
+        """
+        if not isinstance(graphObject, GraphObject):
+            raise TypeError("Only GraphObjects can be stored, not %r." % (graphObject,))
+        with self._lock:
+            existing = self._ids.get(graphObject)
+            if existing is not None:
+                return existing
+            if id is None:
+                id = uuid.uuid4().hex
+            elif id in self:
+                raise KeyError("An object with id %r is already stored." % (id,))
+            self._objects[id] = graphObject
+            self._ids[graphObject] = id
+            self._new[id] = graphObject
+            for graphMethod in graphObject._savedGraphMethods:
+                for node in list(getattr(graphObject, graphMethod.name)._nodes.values()):
+                    if node.isSet():
+                        self._dirty[(id, graphMethod.name, node.args)] = node
+            return id
+
+    def idOf(self, graphObject):
+        """Returns the id of an object in the store, or None if it hasn't
+        been added to or loaded from it.
+
+        """
+        return self._ids.get(graphObject)
+
+    def get(self, id, load=True):
+        """Returns the object with the given id, loading it if it isn't
+        loaded already.  Raises a KeyError if there is no such object.
+
+        If load is False, returns None rather than load the object.
+
+        """
+        if not load:
+            return self._objects.get(id)
+        return self.getMany([id])[0]
+
+    def getMany(self, ids):
+        """Returns a list of the objects with the given ids, loading
+        those that aren't loaded already together.  Raises a KeyError if
+        any of the objects doesn't exist.
+
+        """
+        # The store is locked while the objects are read and created,
+        # and again while they are registered, but not while their
+        # values are set: that holds the graph for writing, and a set
+        # on another thread holds the graph while it tells the store.
+        # Meanwhile other threads wait for the objects being loaded,
+        # rather than see them half done.
+        #
+        ids = list(ids)
+        ident = get_ident()
+        with self._lock:
+            while True:
+                loaded = {}
+                missing = []
+                waiting = False
+                for id in set(ids):
+                    loader = self._loading.get(id)
+                    if loader is not None and loader != ident:
+                        waiting = True
+                        continue
+                    graphObject = self._objects.get(id)
+                    if graphObject is not None:
+                        loaded[id] = graphObject
+                    else:
+                        missing.append(id)
+                if not waiting:
+                    break
+                self._loaded.wait()
+            if not missing:
+                return [loaded[id] for id in ids]
+            records = self.read(missing)
+            for id in missing:
+                if id not in records:
+                    raise KeyError(id)
+
+            # The objects are registered before their values are read,
+            # so values that refer to them (or to each other) find them.
+            # They are only identified once set, so the sets aren't
+            # taken for changes.
+            #
+            for id in missing:
+                loaded[id] = _classNamed(records[id][0])()
+                self._objects[id] = loaded[id]
+                self._loading[id] = ident
+        try:
+            for id in missing:
+                graphObject = loaded[id]
+                values = [(name, self.loads(args), self.loads(value))
+                          for name, args, value in records[id][1]]
+                with self._graph.batch():
+                    for name, args, value in values:
+                        graphInstanceMethod = getattr(graphObject, name, None)
+                        if graphInstanceMethod is not None and graphInstanceMethod.graphMethod.isSaved():
+                            self._graph.setValue(graphInstanceMethod.node(*args), value)
+        except:
+            with self._lock:
+                for id in missing:
+                    self._objects.pop(id, None)
+                    del self._loading[id]
+                self._loaded.notify_all()
+            raise
+        with self._lock:
+            for id in missing:
+                self._ids[loaded[id]] = id
+                del self._loading[id]
+            self._loaded.notify_all()
+        return [loaded[id] for id in ids]
+
+    def __contains__(self, id):
+        return id in self._objects or id in self.read([id])
+
+    def remove(self, id):
+        """Removes the object with the given id from the store at once.
+        The object itself, if loaded, is unaffected.
+
+        """
+        with self._lock:
+            graphObject = self._objects.pop(id, None)
+            if graphObject is not None:
+                self._ids.pop(graphObject, None)
+            self._new.pop(id, None)
+            for key in [key for key in self._dirty if key[0] == id]:
+                del self._dirty[key]
+            self.delete([id])
+
+    def commit(self):
+        """Writes the objects added and the saved nodes changed since the
+        last commit, and returns the number of values written or removed.
+
+        """
+        with self._lock:
+            objects, values, cleared = [], [], []
+            new, dirty = {}, {}
+            try:
+                # Pickling a value may add the objects it refers to.
+                #
+                while self._new or self._dirty:
+                    for id, graphObject in list(self._new.items()):
+                        objects.append((id, _className(type(graphObject))))
+                    new.update(self._new)
+                    self._new = {}
+                    for key, node in list(self._dirty.items()):
+                        id, name, args = key
+                        if node.isSet():
+                            values.append((id, name, self.dumps(args), self.dumps(node._setValue)))
+                        else:
+                            cleared.append((id, name, self.dumps(args)))
+                        dirty[key] = node
+                        del self._dirty[key]
+                self.write(objects, values, cleared)
+            except:
+                for id, graphObject in new.items():
+                    self._new.setdefault(id, graphObject)
+                for key, node in dirty.items():
+                    self._dirty.setdefault(key, node)
+                raise
+            return len(values) + len(cleared)
+
+    def close(self):
+        """Stops listening to the graph.  Changes not yet committed are
+        discarded.
+
+        """
+        self._graph.removeListener(self._nodeChanged)
+
+    def _nodeChanged(self, node):
+        if not node.graphMethod.isSaved():
+            return
+        id = self._ids.get(node.graphObject)
+        if id is not None:
+            with self._lock:
+                self._dirty[(id, node.graphMethod.name, node.args)] = node
+
+    def dumps(self, value, add=True):
+        """Returns a value pickled as the store saves it, with the
+        GraphObjects it refers to added to the store.
+
+        If add is False, raises a PicklingError rather than add an
+        object.
+
+        """
+        output = io.BytesIO()
+        pickler = pickle.Pickler(output, 2)
+        pickler.persistent_id = lambda value: self._persistentId(value, add)
+        pickler.dump(value)
+        return output.getvalue()
+
+    def loads(self, data, load=True):
+        """Returns a value pickled by dumps(), loading the GraphObjects
+        it refers to.
+
+        If load is False, raises an UnpicklingError rather than load an
+        object.
+
+        """
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = lambda id: self._persistentLoad(id, load)
+        return unpickler.load()
+
+    def _persistentId(self, value, add):
+        """Returns the id by which a pickled value refers to an object."""
+        if not isinstance(value, GraphObject):
+            return None
+        if add:
+            return self.add(value)
+        id = self._ids.get(value)
+        if id is None:
+            raise pickle.PicklingError("%r is not in the store." % (value,))
+        return id
+
+    def _persistentLoad(self, id, load):
+        graphObject = self.get(id, load)
+        if graphObject is None:
+            raise pickle.UnpicklingError("Object %r is not loaded." % (id,))
+        return graphObject
+
+    # The storage backend.
+
+    def read(self, ids):
+        """Returns a dictionary of (className, values) by id for those of
+        the objects stored, where values is a list of the (name, args,
+        value) of each saved node, with args and value pickled.
+
+        """
+        raise NotImplementedError()
+
+    def write(self, objects, values, cleared):
+        """Atomically stores (id, className) for each new object and (id,
+        name, args, value) for each saved node, replacing any value it
+        has, and removes the values of each (id, name, args) cleared.
+
+        """
+        raise NotImplementedError()
+
+    def delete(self, ids):
+        """Removes the objects, and their values, with the given ids.
+
+        """
+        raise NotImplementedError()
+
+    def keys(self):
+        """Returns the ids of all of the objects stored.
+
+        """
+        raise NotImplementedError()
+
+class SQLiteStore(Store):
+    """A Store kept in an SQLite database, which may be ':memory:'.
+
+    """
+    # Ids per query, which SQLite limits the parameters of.
+    #
+    _chunkSize = 500
+
+    def __init__(self, path, graph=None):
+        Store.__init__(self, graph)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS objects ('
+                    'id TEXT PRIMARY KEY, class TEXT NOT NULL)')
+            self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS saved ('
+                    'id TEXT NOT NULL, name TEXT NOT NULL, args BLOB NOT NULL, value BLOB NOT NULL, '
+                    'PRIMARY KEY (id, name, args))')
+
+    def read(self, ids):
+        records = {}
+        with self._lock:
+            for start in range(0, len(ids), self._chunkSize):
+                chunk = ids[start:start + self._chunkSize]
+                marks = ', '.join('?' * len(chunk))
+                for id, className in self._connection.execute(
+                        'SELECT id, class FROM objects WHERE id IN (%s)' % marks, chunk):
+                    records[id] = (className, [])
+                for id, name, args, value in self._connection.execute(
+                        'SELECT id, name, args, value FROM saved WHERE id IN (%s)' % marks, chunk):
+                    if id in records:
+                        records[id][1].append((name, bytes(args), bytes(value)))
+        return records
+
+    def write(self, objects, values, cleared):
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                        'INSERT OR REPLACE INTO objects (id, class) VALUES (?, ?)', objects)
+                self._connection.executemany(
+                        'INSERT OR REPLACE INTO saved (id, name, args, value) VALUES (?, ?, ?, ?)',
+                        [(id, name, sqlite3.Binary(args), sqlite3.Binary(value))
+                         for id, name, args, value in values])
+                self._connection.executemany(
+                        'DELETE FROM saved WHERE id = ? AND name = ? AND args = ?',
+                        [(id, name, sqlite3.Binary(args)) for id, name, args in cleared])
+
+    def delete(self, ids):
+        with self._lock:
+            with self._connection:
+                self._connection.executemany('DELETE FROM saved WHERE id = ?', [(id,) for id in ids])
+                self._connection.executemany('DELETE FROM objects WHERE id = ?', [(id,) for id in ids])
+
+    def keys(self):
+        with self._lock:
+            return [id for id, in self._connection.execute('SELECT id FROM objects')]
+
+    def close(self):
+        Store.close(self)
+        self._connection.close()
+
+def _className(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+def _classNamed(className):
+    moduleName, name = className.rsplit('.', 1)
+    return getattr(importlib.import_module(moduleName), name)
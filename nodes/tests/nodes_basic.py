@@ -1,4 +1,6 @@
+import gc
 import nodes
+import sys
 import unittest
 
 class NodesClass1(nodes.GraphObject):
@@ -56,6 +58,137 @@ class NodesClass4(nodes.GraphObject):
     def X(self):
         return True
 
+class NodesClass5(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Base(self):
+        return 0
+
+    @nodes.graphMethod
+    def Chain(self, i):
+        if i == 0:
+            return self.Base()
+        return self.Chain(i - 1) + 1
+
+    @nodes.graphMethod
+    def Diamond(self, i):
+        if i == 0:
+            return self.Base()
+        return self.Left(i) + self.Right(i)
+
+    @nodes.graphMethod
+    def Left(self, i):
+        return self.Diamond(i - 1)
+
+    @nodes.graphMethod
+    def Right(self, i):
+        return self.Diamond(i - 1)
+
+class NodesClass6(nodes.GraphObject):
+
+    @nodes.graphMethod
+    def A(self):
+        if self.Switch():
+            return self.B()
+        return self.C()
+
+    @nodes.graphMethod(nodes.Settable)
+    def Switch(self):
+        return True
+
+    @nodes.graphMethod(nodes.Settable)
+    def B(self):
+        return 'b'
+
+    @nodes.graphMethod(nodes.Settable)
+    def C(self):
+        return 'c'
+
+class NodesClass7(nodes.GraphObject):
+
+    calls = None
+
+    @nodes.graphMethod(nodes.Settable)
+    def X(self):
+        return 1.1
+
+    @nodes.graphMethod
+    def Rounded(self):
+        self.calls.append('Rounded')
+        return round(self.X())
+
+    @nodes.graphMethod
+    def Doubled(self):
+        self.calls.append('Doubled')
+        return self.Rounded() * 2
+
+    @nodes.graphMethod(equality=lambda x, y: abs(x - y) < 0.5)
+    def Approximate(self):
+        self.calls.append('Approximate')
+        return self.X()
+
+    @nodes.graphMethod
+    def Tripled(self):
+        self.calls.append('Tripled')
+        return self.Approximate() * 3
+
+class NodesClass10(nodes.GraphObject):
+
+    calls = None
+
+    @nodes.graphMethod(nodes.Settable)
+    def Flag(self):
+        return True
+
+    @nodes.graphMethod(nodes.Settable)
+    def X(self):
+        return 1
+
+    @nodes.graphMethod
+    def Expensive(self):
+        self.calls.append('Expensive')
+        return 1 / self.X()
+
+    @nodes.graphMethod
+    def Choice(self):
+        if self.Flag():
+            return self.Expensive()
+        return 0
+
+class NodesClass8(NodesClass6):
+
+    staticDiscovery = True
+
+    @nodes.graphMethod
+    def Item(self, i):
+        return self.Items()[i]
+
+    @nodes.graphMethod(nodes.Settable)
+    def Items(self):
+        return ['x', 'y']
+
+    @nodes.graphMethod
+    def Second(self):
+        return self.Item(1)
+
+    @nodes.graphMethod
+    def Lookup(self, i):
+        return self.Item(i)
+
+class NodesClass9(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Saved)
+    def Name(self):
+        return 'unnamed'
+
+    @nodes.graphMethod(nodes.Saved)
+    def Size(self):
+        return len(self.Name())
+
+    @nodes.graphMethod(nodes.Settable)
+    def Scratch(self):
+        return None
+
 class NodesTest1(unittest.TestCase):
 
     def test_simple(self):
@@ -169,6 +302,299 @@ class NodesTest1(unittest.TestCase):
         self.assertRaises(RuntimeError, callableObj=o.SetX)
         self.assertEquals(o.X(), True)
 
+    def test_invalidateLongChain(self):
+        o = NodesClass5()
+        depth = sys.getrecursionlimit() * 2
+        for i in range(depth):
+            self.assertEquals(o.Chain(i), i)
+        o.Base = 1
+        self.assertFalse(o.Chain.node(depth - 1).isValid())
+        for i in range(depth):
+            self.assertEquals(o.Chain(i), i + 1)
+
+    def test_invalidateDiamonds(self):
+        # Each layer doubles the number of paths from Base, so anything
+        # that walks paths rather than nodes won't finish.
+        #
+        o = NodesClass5()
+        for i in range(64):
+            self.assertEquals(o.Diamond(i), 0)
+        o.Base = 1
+        self.assertFalse(o.Diamond.node(63).isValid())
+        self.assertEquals(o.Diamond(3), 8)
+
+    def test_staleEdgesArePruned(self):
+        o = NodesClass6()
+        a, b, c = o.A.node(), o.B.node(), o.C.node()
+        self.assertEquals(o.A(), 'b')
+        self.assertEquals(a.inputs, set([o.Switch.node(), b]))
+        self.assertEquals(b.outputs, set([a]))
+
+        o.Switch = False
+        self.assertEquals(o.A(), 'c')
+        self.assertEquals(a.inputs, set([o.Switch.node(), c]))
+        self.assertEquals(b.outputs, set())
+        self.assertEquals(c.outputs, set([a]))
+
+        o.B = 'x'
+        self.assertTrue(a.isValid())
+        self.assertEquals(o.A(), 'c')
+
+    def test_staticDiscovery(self):
+        o = NodesClass8()
+        a, b, c, switch = o.A.node(), o.B.node(), o.C.node(), o.Switch.node()
+
+        # The edges are known before anything is evaluated...
+        #
+        self.assertEquals(a.inputs, set([switch, b, c]))
+        self.assertEquals(o.Second.node().inputs, set([o.Item.node(1)]))
+        self.assertEquals(o.Item.node(1).inputs, set([o.Items.node()]))
+        self.assertFalse(a.isValid())
+
+        # ...and, since they are all of A's, are kept when a branch
+        # isn't taken.
+        #
+        self.assertEquals(o.A(), 'b')
+        o.Switch = False
+        self.assertEquals(o.A(), 'c')
+        self.assertEquals(a.inputs, set([switch, b, c]))
+        o.B = 'x'
+        self.assertFalse(a.isValid())
+        self.assertEquals(o.A(), 'c')
+
+        # The argument Lookup passes to Item isn't known statically, so
+        # its inputs are still discovered as it runs.
+        #
+        self.assertEquals(o.Lookup.node(0).inputs, set())
+        self.assertEquals(o.Lookup(0), 'x')
+        self.assertEquals(o.Lookup.node(0).inputs, set([o.Item.node(0)]))
+        self.assertEquals(o.Item.node(0).inputs, set([o.Items.node()]))
+        o.Items = ['z', 'w']
+        self.assertEquals(o.Lookup(0), 'z')
+        self.assertEquals(o.Second(), 'w')
+
+    def test_compactNodes(self):
+        o = NodesClass1()
+        self.assertEquals(o.A(), 'xyz')
+        d = o.D.node()
+        self.assertFalse(hasattr(d, '__dict__'))
+        self.assertEquals(d.inputs, set())
+        self.assertTrue(d._inputs is None)
+        self.assertEquals(d.outputs, set([o.C.node()]))
+
+    def test_lazyBinding(self):
+        o = NodesClass1(B='b')
+        self.assertEquals(sorted(o.__dict__), ['B'])
+        self.assertTrue(o.A is o.A)
+        self.assertTrue(isinstance(o.A, nodes.GraphInstanceMethod))
+        self.assertTrue(NodesClass1.A is o.A.graphMethod)
+        self.assertEquals(o.A(), 'byz')
+        o.D = 'w'
+        self.assertEquals(o.A(), 'byw')
+        o.other = 1
+        self.assertEquals(o.other, 1)
+        self.assertRaises(RuntimeError, NodesClass1, other=1)
+
+    def test_fromColumns(self):
+        objects = NodesClass1.fromColumns({'B': ['a', 'b', 'c'], 'D': ['1', '2', '3']})
+        self.assertEquals([o.A() for o in objects], ['ay1', 'by2', 'cy3'])
+        self.assertTrue(objects[0].B.isSet())
+        self.assertFalse(objects[0].C.isSet())
+        objects[1].D = '4'
+        self.assertEquals(objects[1].A(), 'by4')
+        self.assertEquals(len(NodesClass1.fromColumns({}, count=2)), 2)
+        self.assertRaises(ValueError, NodesClass1.fromColumns, {'B': ['a'], 'D': []})
+        self.assertRaises(RuntimeError, NodesClass1.fromColumns, {'A': ['a']})
+
+        objects = NodesClass1.fromRecords([{'B': 'a'}, {}, {'B': 'c', 'C': 'd'}])
+        self.assertEquals([o.A() for o in objects], ['ayz', 'xyz', 'cd'])
+
+        # Static discovery wires the nodes before they are set.
+        #
+        o, = NodesClass8.fromColumns({'Items': [['p', 'q']]})
+        self.assertEquals(o.Second(), 'q')
+
+    def test_fromColumnsRestoresTheCollector(self):
+        paused = nodes.nodes._gcPaused
+        enabled = gc.isenabled()
+        try:
+            gc.disable()
+            NodesClass1.fromColumns({'B': ['a']})
+            self.assertFalse(gc.isenabled())
+
+            gc.enable()
+            with paused():
+                with paused():
+                    self.assertFalse(gc.isenabled())
+                self.assertFalse(gc.isenabled())
+            self.assertTrue(gc.isenabled())
+        finally:
+            if enabled:
+                gc.enable()
+            else:
+                gc.disable()
+
+    def test_toColumns(self):
+        objects = NodesClass9.fromColumns({'Name': ['a', 'bb', 'ccc'], 'Scratch': [1, 2, 3]})
+        objects[2].Size = 10
+        self.assertEquals(list(NodesClass9.toColumns(objects, batchSize=2)), [
+            {'Name': ['a', 'bb'], 'Size': [1, 2]},
+            {'Name': ['ccc'], 'Size': [10]}])
+        self.assertEquals(list(NodesClass9.toJSONLines(objects)), [
+            '{"Name": "a", "Size": 1}', '{"Name": "bb", "Size": 2}', '{"Name": "ccc", "Size": 10}'])
+        self.assertEquals([o.toDict() for o in objects], [
+            {'Name': 'a', 'Size': 1}, {'Name': 'bb', 'Size': 2}, {'Name': 'ccc', 'Size': 10}])
+        with nodes.GraphContext():
+            objects[0].Name.overlayValue('dddd')
+            self.assertEquals(list(NodesClass9.toColumns(objects[:1])), [{'Name': ['dddd'], 'Size': [4]}])
+        self.assertEquals(list(NodesClass9.toColumns([])), [])
+        self.assertRaises(TypeError, list, NodesClass9.toColumns([NodesClass1()]))
+
+    def test_changesSince(self):
+        graph = nodes.getGraph()
+        o1, o2 = NodesClass9(), NodesClass9()
+        checkpoint = graph.checkpoint()
+        o1.Name = 'a'
+        o2.Name = 'b'
+        o1.Scratch = 'not saved'
+        with graph.batch():
+            o1.Size = 10
+            o1.Name = 'c'
+        changes = list(graph.changesSince(checkpoint))
+        self.assertEquals([(c.graphObject, c.name, c.isSet, c.value) for c in changes],
+                          [(o2, 'Name', True, 'b'), (o1, 'Size', True, 10), (o1, 'Name', True, 'c')])
+        self.assertEquals([c.version for c in changes], sorted(c.version for c in changes))
+        self.assertEquals(graph.savedVersion(o1.Name.node()), changes[-1].version)
+        self.assertEquals(graph.savedVersion(o1.Scratch.node()), 0)
+
+        checkpoint = graph.checkpoint()
+        self.assertEquals(list(graph.changesSince(checkpoint)), [])
+        o2.Name.clearSet()
+        self.assertEquals([(c.graphObject, c.name, c.isSet, c.value) for c in graph.changesSince(checkpoint)],
+                          [(o2, 'Name', False, None)])
+
+        self.assertEquals(graph.trimChanges(checkpoint), 2)
+        self.assertEquals(len(list(graph.changesSince(checkpoint))), 1)
+        self.assertRaises(ValueError, list, graph.changesSince(checkpoint - 1))
+
+    def test_batch(self):
+        o = NodesClass1()
+        graph = nodes.getGraph()
+        self.assertEquals(o.A(), 'xyz')
+        with graph.batch():
+            o.B = 'b'
+            o.D = 'd'
+            self.assertEquals(o.A(), 'xyz')
+            self.assertFalse(o.B.isSet())
+        self.assertEquals(o.A(), 'byd')
+
+        def failInBatch():
+            with graph.batch():
+                o.B.clearSet()
+                raise ValueError()
+        self.assertRaises(ValueError, failInBatch)
+        self.assertEquals(o.A(), 'byd')
+
+        graph.applyChanges([nodes.NodeChange(o.B, 'x'), nodes.NodeChange(o.D, 'z')])
+        self.assertEquals(o.A(), 'xyz')
+
+    def test_batchInvalidatesOnce(self):
+        o = NodesClass2()
+        self.assertEquals(o.E(), 'xy')
+        walks = []
+        invalidateCalcs = nodes.nodes._invalidateCalcs
+        def countingInvalidateCalcs(roots):
+            walks.append(roots)
+            invalidateCalcs(roots)
+        nodes.nodes._invalidateCalcs = countingInvalidateCalcs
+        try:
+            with nodes.getGraph().batch():
+                for v in 'abc':
+                    o.G = v
+        finally:
+            nodes.nodes._invalidateCalcs = invalidateCalcs
+        self.assertEquals(len(walks), 1)
+        self.assertEquals(o.E(), 'xc')
+
+    def test_earlyCutoff(self):
+        graph = nodes.getGraph()
+        graph.earlyCutoff = True
+        try:
+            o = NodesClass7()
+            o.calls = calls = []
+            self.assertEquals(o.Doubled(), 2)
+            self.assertEquals(o.Tripled(), 3.3000000000000003)
+            del calls[:]
+
+            o.X = 1.2
+            self.assertFalse(o.Doubled.node().isValid())
+            self.assertEquals(o.Doubled(), 2)
+            self.assertEquals(o.Tripled(), 3.3000000000000003)
+            self.assertEquals(sorted(calls), ['Approximate', 'Rounded'])
+            del calls[:]
+
+            o.X = 2.2
+            self.assertEquals(o.Doubled(), 4)
+            self.assertEquals(o.Tripled(), 6.6000000000000005)
+            self.assertEquals(sorted(calls), ['Approximate', 'Doubled', 'Rounded', 'Tripled'])
+        finally:
+            graph.earlyCutoff = False
+
+    def test_earlyCutoffChecksInputsInOrder(self):
+        graph = nodes.getGraph()
+        graph.earlyCutoff = True
+        try:
+            o = NodesClass10()
+            o.calls = calls = []
+            self.assertEquals(o.Choice(), 1)
+
+            # Flag changed, so Choice no longer reads Expensive, which
+            # would now raise; it is not brought up to date.
+            #
+            with graph.batch():
+                o.Flag = False
+                o.X = 0
+            self.assertEquals(o.Choice(), 0)
+            self.assertEquals(calls, ['Expensive'])
+        finally:
+            graph.earlyCutoff = False
+
+    def test_stabilize(self):
+        o = NodesClass7()
+        o.calls = calls = []
+        graph = nodes.getGraph()
+        graph.observe(o.Doubled.node())
+        graph.observe(o.Tripled.node())
+        try:
+            self.assertEquals(graph.stabilize(), 2)
+            self.assertEquals(graph.stabilize(), 0)
+            self.assertEquals(sorted(calls), ['Approximate', 'Doubled', 'Rounded', 'Tripled'])
+            self.assertTrue(o.Rounded.node()._height < o.Doubled.node()._height)
+
+            del calls[:]
+            o.X = 2.2
+            self.assertEquals(graph.stabilize(), 4)
+            self.assertEquals(sorted(calls[:2]), ['Approximate', 'Rounded'])
+            self.assertEquals(sorted(calls[2:]), ['Doubled', 'Tripled'])
+            self.assertEquals(o.Doubled(), 4)
+            self.assertEquals(o.Tripled(), 6.6000000000000005)
+            self.assertEquals(len(calls), 4)
+        finally:
+            graph.unobserve(o.Doubled.node())
+            graph.unobserve(o.Tripled.node())
+
+    def test_heightsAcrossDiamonds(self):
+        o = NodesClass1()
+        a, b, c = o.D.node(), o.C.node(), o.A.node()
+        b.addOutput(c)
+        c.addInput(b)
+        a.addOutput(b)
+        b.addInput(a)
+        a.addOutput(c)
+        c.addInput(a)
+        a._raiseHeight(c._height + 1)
+        self.assertTrue(a._height < b._height < c._height)
+
 if __name__ == '__main__':
     unittest.main()
 
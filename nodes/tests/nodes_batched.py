@@ -0,0 +1,99 @@
+import nodes
+import unittest
+
+class NodesClass1(nodes.GraphObject):
+
+    calls = []
+
+    @nodes.graphMethod(nodes.Settable)
+    def Factor(self):
+        return 2
+
+    @nodes.graphMethod(nodes.Settable, batched=True)
+    def Scaled(self, values):
+        self.calls.append(list(values))
+        factor = self.Factor()
+        return [value * factor for value in values]
+
+    @nodes.graphMethod
+    def Total(self):
+        return sum(self.Scaled.getValues([1, 2, 3]))
+
+    @nodes.graphMethod
+    def First(self):
+        return self.Scaled(1)
+
+class NodesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.o = NodesClass1()
+        del self.o.calls[:]
+
+    def test_batchedValues(self):
+        o = self.o
+        self.assertEquals(list(o.Scaled.getValues([1, 2, 3])), [2, 4, 6])
+        self.assertEquals(list(o.Scaled.getValues([2, 3, 4])), [4, 6, 8])
+        self.assertEquals(o.Scaled(3), 6)
+        self.assertEquals(o.calls, [[1, 2, 3], [4]])
+
+        # A change to an input invalidates the groups calculated from
+        # it, and each is calculated again in one call along with the
+        # arguments wanted.
+        #
+        o.Factor = 3
+        del o.calls[:]
+        self.assertEquals(o.Scaled(4), 12)
+        self.assertEquals(list(o.Scaled.getValues([1, 4, 5])), [3, 12, 15])
+        self.assertEquals(o.Scaled(2), 6)
+        self.assertEquals(o.calls, [[4], [1, 5, 2, 3]])
+
+    def test_scalarReadsAfterAChange(self):
+        o = self.o
+        arguments = range(1000)
+        self.assertEquals(len(o.Scaled.getValues(arguments)), 1000)
+        o.Factor = 3
+        self.assertEquals([o.Scaled(v) for v in arguments], [v * 3 for v in arguments])
+        self.assertEquals(len(o.calls), 2)
+
+    def test_batchedDependencies(self):
+        o = self.o
+        self.assertEquals(o.Total(), 12)
+        self.assertEquals(o.First(), 2)
+        self.assertEquals(o.calls, [[1, 2, 3]])
+        o.Factor = 10
+        self.assertEquals(o.Total(), 60)
+        self.assertEquals(o.First(), 10)
+
+        # Setting one argument creates a node for it, which the nodes
+        # reading it pick up.
+        #
+        o.Scaled.setValue(100, 1)
+        self.assertTrue(o.Scaled.isSet(1))
+        self.assertFalse(o.Scaled.isSet(2))
+        self.assertEquals(o.First(), 100)
+        self.assertEquals(o.Total(), 150)
+        o.Scaled.clearSet(1)
+        self.assertEquals(o.Total(), 60)
+
+    def test_batchedInContext(self):
+        o = self.o
+        self.assertEquals(o.Total(), 12)
+        with nodes.GraphContext():
+            o.Factor.overlayValue(5)
+            self.assertEquals(list(o.Scaled.getValues([1, 2])), [5, 10])
+            self.assertEquals(o.Total(), 30)
+            o.Scaled.overlayValue(0, 2)
+            self.assertEquals(o.Total(), 20)
+        self.assertEquals(o.Total(), 12)
+        self.assertEquals(o.Scaled(2), 4)
+
+    def test_batchedIsCompact(self):
+        o = self.o
+        graph = nodes.getGraph()
+        count = len(graph.nodes)
+        self.assertEquals(len(o.Scaled.getValues(range(1000))), 1000)
+        self.assertEquals(len(o.calls), 1)
+        self.assertTrue(len(graph.nodes) <= count + 1)
+
+if __name__ == '__main__':
+    unittest.main()
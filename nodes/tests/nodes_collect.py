@@ -0,0 +1,96 @@
+import gc
+import nodes
+import unittest
+import weakref
+
+class NodesClass1(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def A(self):
+        return 'a'
+
+class NodesClass2(nodes.GraphObject):
+
+    @nodes.graphMethod
+    def B(self):
+        return self.Other().A() + 'b'
+
+    @nodes.graphMethod(nodes.Settable)
+    def Other(self):
+        return None
+
+    @nodes.graphMethod
+    def E(self):
+        return self.F('e')
+
+    @nodes.graphMethod(nodes.Settable)
+    def F(self, v):
+        return 'f' + v
+
+class NodesTest(unittest.TestCase):
+
+    def setUp(self):
+        gc.collect()
+        self.graph = nodes.getGraph()
+
+    def test_unreachableObjectsAreCollected(self):
+        o = NodesClass1()
+        self.assertEquals(o.A(), 'a')
+        ref = weakref.ref(o)
+        count = len(self.graph.nodes)
+        del o
+        gc.collect()
+        self.assertTrue(ref() is None)
+        self.assertEquals(len(self.graph.nodes), count - 1)
+
+    def test_inputsLiveAsLongAsTheirOutputs(self):
+        o1 = NodesClass1()
+        o2 = NodesClass2(Other=o1)
+        self.assertEquals(o2.B(), 'ab')
+        ref1, ref2 = weakref.ref(o1), weakref.ref(o2)
+
+        # o2 depends on o1, so o1 stays alive...
+        #
+        del o1
+        gc.collect()
+        self.assertFalse(ref1() is None)
+        self.assertEquals(o2.B(), 'ab')
+
+        # ...but not the other way around.
+        #
+        o1 = ref1()
+        del o2
+        gc.collect()
+        self.assertTrue(ref2() is None)
+        self.assertEquals(o1.A.node().outputs, set())
+
+    def test_deadOutputsArePruned(self):
+        o1 = NodesClass1()
+        for i in range(100):
+            o2 = NodesClass2(Other=o1)
+            self.assertEquals(o2.B(), 'ab')
+            del o2
+        gc.collect()
+        self.assertTrue(len(o1.A.node()._outputs) < 64)
+        o1.A = 'x'
+        self.assertEquals(len(o1.A.node()._outputs), 0)
+
+    def test_collect(self):
+        o = NodesClass2()
+        self.assertEquals(o.E(), 'fe')
+        for v in 'xyz':
+            self.assertEquals(o.F(v), 'f' + v)
+        o.F.setValue('set', 's')
+        count = len(self.graph.nodes)
+
+        # Only the one-off F(x), F(y) and F(z) are orphans; F(e) is an
+        # input to E and F(s) holds a set value.
+        #
+        self.assertEquals(self.graph.collect(), 3)
+        self.assertEquals(len(self.graph.nodes), count - 3)
+        self.assertEquals(o.E(), 'fe')
+        self.assertEquals(o.F('s'), 'set')
+        self.assertEquals(o.F('x'), 'fx')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import nodes
+import unittest
+
+# The nodes calculated, since compiled methods can't record their calls
+# on self.
+#
+calls = []
+
+class NodesClass1(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Rate(self):
+        return 2
+
+    @nodes.graphMethod(nodes.Settable)
+    def Spot(self):
+        return 10
+
+    @nodes.graphMethod(nodes.Settable)
+    def Fee(self):
+        return 1
+
+    @nodes.graphMethod
+    def Costs(self):
+        calls.append('Costs')
+        return self.Fee() * 3
+
+    @nodes.graphMethod
+    def Forward(self):
+        calls.append('Forward')
+        return self.Spot() * self.Rate()
+
+    @nodes.graphMethod
+    def Value(self):
+        if self.Spot() < 0:
+            return self.Fee()
+        return self.Forward() - self.Costs()
+
+    @nodes.graphMethod
+    def Chain(self, i):
+        if i == 0:
+            return self.Spot()
+        return self.Chain(i - 1) + i
+
+    @nodes.graphMethod
+    def Opaque(self):
+        return getattr(self, 'Spot')() + 1
+
+class NodesClass2(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def L(self):
+        return 5
+
+    @nodes.graphMethod
+    def B(self):
+        return self.L() * 100
+
+    @nodes.graphMethod
+    def C(self):
+        return self.B() + self.L() + 1
+
+class NodesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.o = NodesClass1()
+        del calls[:]
+
+    def tearDown(self):
+        del self.o
+
+    def test_compile(self):
+        o = self.o
+        graph = nodes.getGraph()
+        compiled = graph.compile(o.Value, leaves=[o.Spot, o.Rate])
+        self.assertEquals(calls, ['Forward', 'Costs'])
+        self.assertEquals(compiled(10, 2), 17)
+        self.assertEquals(compiled(5, 4), 17)
+        self.assertEquals(compiled(1, 1), -2)
+        self.assertEquals(compiled.fallbacks, 0)
+
+        # The compiled function leaves the nodes as they were, and runs
+        # the methods of only those that depend on the leaves.
+        #
+        self.assertEquals(calls, ['Forward', 'Costs', 'Forward', 'Forward', 'Forward'])
+        del calls[:]
+        self.assertEquals(o.Value(), 17)
+        self.assertEquals(calls, [])
+
+        # By default the leaves are the settable nodes beneath the root.
+        #
+        compiled = graph.compile(o.Value)
+        self.assertEquals([leaf.graphMethod.name for leaf in compiled.leaves], ['Fee', 'Rate', 'Spot'])
+        self.assertEquals(compiled(2, 3, 4), 6)
+
+    def test_compileFallsBack(self):
+        o = self.o
+        compiled = nodes.getGraph().compile(o.Value, leaves=[o.Spot])
+        self.assertEquals(compiled(-1), 1)
+        self.assertEquals(compiled.fallbacks, 1)
+        self.assertEquals(compiled(3), 3)
+        self.assertEquals(compiled.fallbacks, 1)
+        with nodes.GraphContext():
+            o.Rate.overlayValue(5)
+            self.assertEquals(compiled(3), 12)
+        self.assertEquals(compiled.fallbacks, 2)
+        self.assertEquals(o.Value(), 17)
+
+    def test_compileRecompiles(self):
+        o = self.o
+        compiled = nodes.getGraph().compile(o.Value, leaves=[o.Spot])
+        self.assertEquals(compiled(3), 3)
+        o.Fee = 2
+        self.assertEquals(compiled(3), 0)
+        o.Fee.clearSet()
+        self.assertEquals(compiled(3), 3)
+        self.assertEquals(compiled.fallbacks, 0)
+
+    def test_compileArguments(self):
+        o = self.o
+        compiled = nodes.getGraph().compile(o.Chain.node(3), leaves=[o.Spot])
+        self.assertEquals(compiled(0), 6)
+        self.assertEquals(compiled(4), 10)
+        self.assertEquals(compiled.fallbacks, 0)
+
+    def test_compileOrderFollowsEdges(self):
+        o = NodesClass2()
+        self.assertEquals(o.C(), 506)
+
+        # Heights only bound the order of the nodes, so the order is
+        # found from the edges, whatever the heights.
+        #
+        for node in (o.L.node(), o.B.node(), o.C.node()):
+            node._height = 0
+        compiled = nodes.getGraph().compile(o.C, leaves=[o.L])
+        self.assertEquals(compiled(5), 506)
+        self.assertEquals(compiled(1), 102)
+
+    def test_compileRaises(self):
+        o = self.o
+        self.assertRaises(RuntimeError, nodes.getGraph().compile, o.Opaque)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,11 @@
 import nodes
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class NodesClass1(nodes.GraphObject):
 
     @nodes.graphMethod(nodes.Settable)
@@ -19,6 +24,50 @@ class NodesClass1(nodes.GraphObject):
     def D(self):
         return 'D'
 
+class NodesClass2(nodes.GraphObject):
+
+    calls = []
+
+    @nodes.graphMethod(nodes.Settable)
+    def X(self):
+        return 1
+
+    @nodes.graphMethod(nodes.Settable)
+    def Y(self):
+        return 10
+
+    @nodes.graphMethod
+    def Sum(self):
+        self.calls.append('Sum')
+        return self.X() + self.Y()
+
+    @nodes.graphMethod
+    def Doubled(self):
+        self.calls.append('Doubled')
+        return self.Sum() * 2
+
+    @nodes.graphMethod
+    def Scaled(self):
+        self.calls.append('Scaled')
+        return self.Y() * 10
+
+    @nodes.graphMethod
+    def Total(self):
+        self.calls.append('Total')
+        return self.Doubled() + self.Scaled()
+
+class NodesClass3(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Base(self):
+        return 0
+
+    @nodes.graphMethod
+    def Chain(self, i):
+        if i == 0:
+            return self.Base()
+        return self.Chain(i - 1) + 1
+
 class NodesTest(unittest.TestCase):
 
     def setUp(self):
@@ -124,6 +173,255 @@ class NodesTest(unittest.TestCase):
             self.assertInitialGraphValues()
         self.assertInitialGraphValues()
 
+    def test_inheritedOverlays(self):
+        o = self.o
+        parent = nodes.GraphContext()
+        parent.addOverlay(o.B.node(), 'b')
+        parent.addOverlay(o.D.node(), 'd')
+        child = nodes.GraphContext(parentGraphContext=parent)
+        child.removeOverlay(o.D.node())
+        child.removeOverlay(o.C.node())
+        self.assertEquals(child.allOverlays(), {o.B.node(): 'b'})
+        with child:
+            self.assertEquals(o.A(), 'AbCD')
+
+        # Changes to the parent reach the child, except where the
+        # child removed the overlay.
+        #
+        parent.addOverlay(o.B.node(), 'x')
+        parent.addOverlay(o.C.node(), 'c')
+        self.assertEquals(child.getOverlay(o.B.node()), 'x')
+        self.assertFalse(child.hasOverlay(o.C.node()))
+        self.assertFalse(child.hasOverlay(o.B.node(), includeParent=False))
+        with child:
+            self.assertEquals(o.A(), 'AxCD')
+        with parent:
+            self.assertEquals(o.A(), 'Axc')
+        self.assertInitialGraphValues()
+
+    def test_evaluateScenarios(self):
+        o = self.o
+        with nodes.GraphContext() as c:
+            o.B.overlayValue('b')
+        scenarios = [c, {o.D: 'd'}, {o.B: '1', o.C.node(): '2'}, {}]
+        expected = [['AbCD', 'CD'], ['ABCd', 'Cd'], ['A12', '2'], ['ABCD', 'CD']]
+        for processes in (1, 2):
+            results = dict(nodes.GraphContext.evaluateScenarios(scenarios, [o.A, o.C], processes=processes))
+            self.assertEquals([results[i] for i in range(len(scenarios))], expected)
+            self.assertInitialGraphValues()
+        with nodes.GraphContext():
+            o.D.overlayValue('x')
+            results = dict(nodes.GraphContext.evaluateScenarios(scenarios, [o.A], processes=2))
+            self.assertEquals(results[3], ['ABCx'])
+            self.assertEquals(results[0], ['AbCx'])
+        self.assertInitialGraphValues()
+
+    def test_contextCache(self):
+        o = NodesClass2()
+        calls = o.calls
+        with nodes.GraphContext() as c:
+            o.X.overlayValue(2)
+            self.assertEquals(o.Doubled(), 24)
+        self.assertEquals(o.Doubled(), 22)
+        del calls[:]
+        with c:
+            self.assertEquals(o.Doubled(), 24)
+        self.assertEquals(calls, [])
+        with nodes.GraphContext() as d:
+            o.X.overlayValue(3)
+            self.assertEquals(o.Doubled(), 26)
+        with c:
+            self.assertEquals(o.Doubled(), 24)
+        self.assertEquals(sorted(calls), ['Doubled', 'Sum'])
+        self.assertEquals(o.Doubled(), 22)
+
+        # A change beneath the context, or to its overlays, discards
+        # its values.
+        #
+        o.Y = 20
+        del calls[:]
+        with c:
+            self.assertEquals(o.Doubled(), 44)
+        self.assertEquals(sorted(calls), ['Doubled', 'Sum'])
+        c.addOverlay(o.X.node(), 5)
+        del calls[:]
+        with c:
+            self.assertEquals(o.Doubled(), 50)
+        self.assertEquals(sorted(calls), ['Doubled', 'Sum'])
+        with c:
+            o.Y.overlayValue(0)
+            self.assertEquals(o.Doubled(), 10)
+        del calls[:]
+        with c:
+            self.assertEquals(o.Doubled(), 50)
+        self.assertEquals(sorted(calls), ['Doubled', 'Sum'])
+        self.assertEquals(o.Doubled(), 42)
+
+    def test_contextsLeaveValuesIntact(self):
+        o = NodesClass2()
+        calls = o.calls
+        self.assertEquals(o.Doubled(), 22)
+        del calls[:]
+        with nodes.GraphContext():
+            o.X.overlayValue(2)
+            self.assertTrue(o.X.isOverlaid())
+            self.assertEquals(o.Doubled(), 24)
+            self.assertEquals(o.Scaled(), 100)
+        self.assertFalse(o.X.isOverlaid())
+        self.assertEquals(sorted(calls), ['Doubled', 'Scaled', 'Sum'])
+        del calls[:]
+
+        # Scaled isn't affected by the overlay, so its value was stored
+        # on the graph itself.
+        #
+        self.assertEquals(o.Doubled(), 22)
+        self.assertEquals(o.Scaled(), 100)
+        self.assertEquals(calls, [])
+        self.assertTrue(o.Doubled.node().isCalced())
+
+    def test_deepChainsInContexts(self):
+        o = NodesClass3()
+        other = NodesClass1()
+        for i in range(2000):
+            o.Chain(i)
+        with nodes.GraphContext():
+            other.B.overlayValue('b')
+            self.assertEquals(o.Chain(1999), 1999)
+        self.assertTrue(o.Chain.node(1999).isCalced())
+
+    def test_reenteringAnActiveContext(self):
+        o = self.o
+        graphContext = nodes.GraphContext()
+        with graphContext:
+            o.B.overlayValue('b')
+            def reenter():
+                with graphContext:
+                    pass
+            self.assertRaises(RuntimeError, reenter)
+            self.assertEquals(o.A(), 'AbCD')
+        self.assertInitialGraphValues()
+
+    def test_nestedContextsShareValues(self):
+        o = NodesClass2()
+        other = NodesClass2()
+        calls = o.calls
+        with nodes.GraphContext():
+            o.X.overlayValue(2)
+            with nodes.GraphContext():
+                other.X.overlayValue(0)
+                self.assertEquals(o.Doubled(), 24)
+                o.Y.overlayValue(0)
+                self.assertEquals(o.Doubled(), 4)
+            del calls[:]
+            self.assertEquals(o.Doubled(), 24)
+            self.assertEquals(calls, [])
+        self.assertEquals(o.Doubled(), 22)
+
+    def test_forkSharesValues(self):
+        o = NodesClass2()
+        other = NodesClass2()
+        calls = o.calls
+        parent = nodes.GraphContext()
+        parent.addOverlay(o.X.node(), 2)
+        first = parent.fork()
+        first.addOverlay(other.X.node(), 0)
+        second = parent.fork()
+        second.addOverlay(other.Y.node(), 0)
+        del calls[:]
+        with first:
+            self.assertEquals(o.Doubled(), 24)
+        self.assertEquals(sorted(calls), ['Doubled', 'Sum'])
+
+        # Doubled isn't affected by the children's own overlays, so
+        # its value was kept with the parent's, for every child.
+        #
+        del calls[:]
+        with second:
+            self.assertEquals(o.Doubled(), 24)
+            self.assertEquals(other.Doubled(), 2)
+        with parent:
+            self.assertEquals(o.Doubled(), 24)
+        self.assertEquals(calls, ['Doubled', 'Sum'])
+        self.assertEquals(parent.allOverlays(), {o.X.node(): 2})
+        self.assertEquals(second.allOverlays(), {o.X.node(): 2, other.Y.node(): 0})
+        self.assertEquals(o.Doubled(), 22)
+
+    def test_enteringAParentBeneathItsFork(self):
+        o = NodesClass2()
+        parent = nodes.GraphContext()
+        parent.addOverlay(o.X.node(), 2)
+        child = parent.fork()
+        child.addOverlay(o.Y.node(), 0)
+        with child:
+            def enterParent():
+                with parent:
+                    pass
+            self.assertRaises(RuntimeError, enterParent)
+            self.assertEquals(o.Sum(), 2)
+        with parent:
+            self.assertEquals(o.Sum(), 12)
+        self.assertEquals(o.Sum(), 11)
+
+    def test_forkClearsInheritedOverlay(self):
+        o = NodesClass2()
+        parent = nodes.GraphContext()
+        parent.addOverlay(o.X.node(), 2)
+        parent.addOverlay(o.Y.node(), 20)
+        with parent.fork() as child:
+            self.assertEquals(o.Doubled(), 44)
+            o.X.clearOverlay()
+            self.assertFalse(o.X.isOverlaid())
+            self.assertEquals(o.Doubled(), 42)
+        self.assertEquals(child.allOverlays(), {o.Y.node(): 20})
+        with child:
+            self.assertEquals(o.Doubled(), 42)
+        with parent:
+            self.assertEquals(o.Doubled(), 44)
+        self.assertEquals(o.Doubled(), 22)
+
+    def test_sweep(self):
+        o = NodesClass2()
+        calls = o.calls
+        del calls[:]
+        graph = nodes.getGraph()
+        self.assertEquals(graph.sweep(o.Total, o.X, [0, 1, 2]), [120, 122, 124])
+        self.assertEquals(calls.count('Scaled'), 1)
+        self.assertEquals(calls.count('Sum'), 3)
+        self.assertFalse(o.X.isOverlaid())
+        self.assertEquals(o.Total(), 122)
+        with nodes.GraphContext():
+            o.Y.overlayValue(0)
+            self.assertEquals(graph.sweep(o.Total.node(), o.X.node(), [5]), [10])
+            self.assertEquals(o.Total(), 2)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_sweepAsArray(self):
+        o = NodesClass2()
+        values = nodes.getGraph().sweep(o.Sum, o.X, numpy.arange(3), asArray=True)
+        self.assertTrue(isinstance(values, numpy.ndarray))
+        self.assertEquals(list(values), [10, 11, 12])
+
+    def test_persistentMap(self):
+        import random
+        random.seed(0)
+        empty = nodes.nodes._PersistentMap()
+        maps = [(empty, {})]
+        for i in range(2000):
+            persistent, expected = random.choice(maps)
+            key = random.randrange(300)
+            expected = dict(expected)
+            if random.random() < 0.7:
+                expected[key] = i
+                persistent = persistent.set(key, i)
+            else:
+                expected.pop(key, None)
+                persistent = persistent.discard(key)
+            maps.append((persistent, expected))
+        for persistent, expected in maps[::50]:
+            self.assertEquals(len(persistent), len(expected))
+            self.assertEquals(dict(persistent.items()), expected)
+        self.assertEquals(len(empty), 0)
+
 if __name__ == '__main__':
     unittest.main()
 
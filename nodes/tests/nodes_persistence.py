@@ -0,0 +1,232 @@
+import nodes
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# The nodes calculated.
+#
+calls = []
+
+class NodesClass1(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Saved)
+    def Name(self):
+        return 'unnamed'
+
+    @nodes.graphMethod(nodes.Saved)
+    def Quantity(self, day):
+        return 0
+
+    @nodes.graphMethod(nodes.Settable)
+    def Scratch(self):
+        return None
+
+    @nodes.graphMethod
+    def Label(self):
+        return '%s:%s' % (self.Name(), self.Quantity(1))
+
+class NodesClass2(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Saved)
+    def Other(self):
+        return None
+
+class NodesClass3(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Saved)
+    def Source(self):
+        return None
+
+    @nodes.graphMethod(nodes.Settable)
+    def Factor(self):
+        return 2
+
+    @nodes.graphMethod
+    def Scaled(self, i):
+        calls.append(('Scaled', i))
+        return self.Source().Quantity(i) * self.Factor()
+
+    @nodes.graphMethod
+    def Total(self):
+        calls.append('Total')
+        return sum(self.Scaled(i) for i in range(3))
+
+class RecordingStore(nodes.SQLiteStore):
+    """Records the values it writes."""
+
+    def __init__(self, path):
+        nodes.SQLiteStore.__init__(self, path)
+        self.written = []
+
+    def write(self, objects, values, cleared):
+        self.written.append((len(objects), len(values), len(cleared)))
+        nodes.SQLiteStore.write(self, objects, values, cleared)
+
+class SettingStore(nodes.SQLiteStore):
+    """Sets a Saved node from another thread while reading."""
+
+    def read(self, ids):
+        if self.target is not None:
+            target, self.target = self.target, None
+            self.setter = threading.Thread(target=lambda: setattr(target, 'Name', 'changed'))
+            self.setter.daemon = True
+            self.setter.start()
+            time.sleep(0.05)
+        return nodes.SQLiteStore.read(self, ids)
+
+class NodesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'objects.db')
+        self.stores = []
+
+    def tearDown(self):
+        nodes.getGraph().restore(None)
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        store = RecordingStore(self.path)
+        self.stores.append(store)
+        return store
+
+    def test_saveAndLoad(self):
+        store = self.open()
+        o = NodesClass1(Name='a', Scratch='scratch')
+        o.Quantity.setValue(5, 1)
+        id = store.add(o)
+        self.assertTrue(store.get(id) is o)
+        self.assertEquals(store.commit(), 2)
+        self.assertEquals(store.written, [(1, 2, 0)])
+
+        store = self.open()
+        self.assertEquals(store.keys(), [id])
+        self.assertTrue(id in store)
+        p = store.get(id)
+        self.assertFalse(p is o)
+        self.assertTrue(store.get(id) is p)
+        self.assertTrue(store.idOf(p) == id)
+        self.assertEquals(p.Label(), 'a:5')
+        self.assertFalse(p.Scratch.isSet())
+        self.assertFalse(p.Quantity.isSet(2))
+
+        # Loading an object isn't a change to it.
+        #
+        self.assertEquals(store.commit(), 0)
+        self.assertRaises(KeyError, store.get, 'missing')
+
+    def test_incrementalCommits(self):
+        store = self.open()
+        objects = [NodesClass1(Name=str(i)) for i in range(10)]
+        ids = [store.add(o) for o in objects]
+        store.commit()
+        objects[3].Name = 'three'
+        objects[3].Name = 'Three'
+        objects[4].Quantity.setValue(4, 2)
+        objects[5].Scratch = 'not saved'
+        objects[6].Name.clearSet()
+        self.assertEquals(store.commit(), 3)
+        self.assertEquals(store.written, [(10, 10, 0), (0, 2, 1)])
+
+        store = self.open()
+        loaded = store.getMany(ids[3:7])
+        self.assertEquals([o.Label() for o in loaded], ['Three:0', '4:0', '5:0', 'unnamed:0'])
+        self.assertEquals(loaded[1].Quantity(2), 4)
+
+    def test_references(self):
+        store = self.open()
+        o1 = NodesClass1(Name='one')
+        o2 = NodesClass2(Other=o1)
+        id2 = store.add(o2)
+        store.commit()
+        self.assertEquals(len(store.keys()), 2)
+
+        store = self.open()
+        p2 = store.get(id2)
+        self.assertEquals(p2.Other().Name(), 'one')
+        self.assertTrue(p2.Other() is store.get(store.idOf(p2.Other())))
+
+        # Objects that refer to each other load together.
+        #
+        p2.Other = p2
+        store.commit()
+        store = self.open()
+        p2 = store.get(id2)
+        self.assertTrue(p2.Other() is p2)
+
+    def test_snapshot(self):
+        store = self.open()
+        o1 = NodesClass1()
+        for i in range(3):
+            o1.Quantity.setValue(i + 1, i)
+        o3 = NodesClass3(Source=o1, Factor=10)
+        id3 = store.add(o3)
+        store.commit()
+        self.assertEquals(o3.Total(), 60)
+        path = os.path.join(self.directory, 'graph.snapshot')
+        self.assertEquals(nodes.getGraph().snapshot(path, store), 9)
+
+        # In a "new process" the objects are loaded again, and nodes
+        # looked up are seeded from the snapshot rather than calculated.
+        #
+        store = self.open()
+        nodes.getGraph().restore(path, store)
+        del calls[:]
+        p3 = store.get(id3)
+        self.assertEquals(p3.Factor(), 10)
+        self.assertEquals(p3.Total(), 60)
+        self.assertEquals(calls, [])
+        self.assertEquals(p3.Scaled(1), 20)
+        self.assertEquals(calls, [])
+
+        # The restored values and edges behave like any other.
+        #
+        p3.Source().Quantity.setValue(5, 1)
+        self.assertEquals(p3.Total(), 90)
+        self.assertEquals(calls, ['Total', ('Scaled', 1)])
+
+        # A value whose inputs changed since the snapshot is calculated.
+        #
+        store = self.open()
+        nodes.getGraph().restore(path, store)
+        p3 = store.get(id3)
+        p3.Factor = 1
+        del calls[:]
+        self.assertEquals(p3.Total(), 6)
+        self.assertEquals(calls, ['Total', ('Scaled', 0), ('Scaled', 1), ('Scaled', 2)])
+
+    def test_remove(self):
+        store = self.open()
+        id = store.add(NodesClass1(Name='a'))
+        store.commit()
+        store.remove(id)
+        self.assertFalse(id in store)
+        self.assertEquals(self.open().keys(), [])
+
+    def test_loadWhileAnotherThreadSets(self):
+        store = self.open()
+        id = store.add(NodesClass1(Name='a'))
+        store.commit()
+        store = SettingStore(self.path)
+        self.stores.append(store)
+        target = NodesClass1(Name='b')
+        store.add(target)
+        store.target = target
+        results = []
+        loader = threading.Thread(target=lambda: results.append(store.get(id)))
+        loader.daemon = True
+        loader.start()
+        loader.join(5)
+        store.setter.join(5)
+        self.assertFalse(loader.is_alive() or store.setter.is_alive())
+        self.assertEquals(results[0].Name(), 'a')
+        self.assertEquals(target.Name(), 'changed')
+        self.assertEquals(store.commit(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import multiprocessing.pool
+import nodes
+import threading
+import time
+import unittest
+
+class NodesClass1(nodes.GraphObject):
+
+    calls = None
+
+    @nodes.graphMethod
+    def Slow(self):
+        self.calls.append('Slow')
+        time.sleep(0.05)
+        return self.X() + 1
+
+    @nodes.graphMethod(nodes.Settable)
+    def X(self):
+        return 1
+
+    @nodes.graphMethod
+    def Y(self):
+        return self.X() * 2
+
+class Rendezvous(object):
+    """Lets a number of threads wait for each other to arrive, or give
+    up after a timeout.
+
+    """
+    def __init__(self, count):
+        self.count = count
+        self.arrived = 0
+        self.condition = threading.Condition()
+
+    def wait(self, timeout=5):
+        deadline = time.time() + timeout
+        with self.condition:
+            self.arrived += 1
+            self.condition.notify_all()
+            while self.arrived < self.count and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return self.arrived >= self.count
+
+class Position(nodes.GraphObject):
+
+    rendezvous = None
+    threads = None
+
+    @nodes.graphMethod
+    def Value(self):
+        if self.rendezvous is not None:
+            self.rendezvous.met.append(self.rendezvous.wait())
+        if self.threads is not None:
+            self.threads.add(threading.current_thread())
+        return self.Quantity() * 10
+
+    @nodes.graphMethod(nodes.Settable)
+    def Quantity(self):
+        return 1
+
+class Portfolio(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Positions(self):
+        return []
+
+    @nodes.graphMethod
+    def Value(self):
+        values = nodes.getGraph().evaluateParallel(position.Value.node() for position in self.Positions())
+        return sum(values)
+
+def inThreads(count, target):
+    results = [None] * count
+    def run(i):
+        results[i] = target()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+class NodesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.o = NodesClass1()
+        self.o.calls = []
+
+    def test_concurrentReadersShareOneCalculation(self):
+        o = self.o
+        self.assertEquals(inThreads(4, o.Slow), [2, 2, 2, 2])
+        self.assertEquals(o.calls, ['Slow'])
+
+    def test_dependencyTrackingIsPerThread(self):
+        o = self.o
+        thread = threading.Thread(target=o.Slow)
+        thread.start()
+        time.sleep(0.01)
+        self.assertEquals(o.Y(), 2)
+        thread.join()
+        self.assertEquals(o.Slow.node().inputs, set([o.X.node()]))
+        self.assertEquals(o.Y.node().outputs, set())
+
+    def test_setsWaitForEvaluations(self):
+        o = self.o
+        thread = threading.Thread(target=o.Slow)
+        thread.start()
+        time.sleep(0.01)
+        o.X = 2
+        thread.join()
+        self.assertEquals(o.Slow(), 3)
+        self.assertEquals(o.calls, ['Slow', 'Slow'])
+
+    def test_readersNeverSeeHalfWrittenNodes(self):
+        o = self.o
+        done = threading.Event()
+        def write():
+            for i in range(2000):
+                o.X = i
+            done.set()
+        def read():
+            values = []
+            while not done.is_set():
+                values.append(o.Y())
+            return values
+        writer = threading.Thread(target=write)
+        writer.start()
+        results = inThreads(3, read)
+        writer.join()
+        for values in results:
+            self.assertFalse(None in values)
+
+    def test_contextsDontBlockReaders(self):
+        o = self.o
+        results = []
+        with nodes.GraphContext() as graphContext:
+            o.X.overlayValue(5)
+            self.assertEquals(o.Y(), 10)
+
+            # Other threads read the graph without the overlay...
+            #
+            thread = threading.Thread(target=lambda: results.append(o.Y()))
+            thread.start()
+            thread.join()
+            self.assertEquals(results, [2])
+
+            # ...but can't use the context while it is active here...
+            #
+            def enter():
+                try:
+                    with graphContext:
+                        pass
+                except RuntimeError:
+                    results.append('refused')
+            thread = threading.Thread(target=enter)
+            thread.start()
+            thread.join()
+            self.assertEquals(results, [2, 'refused'])
+
+            # ...and their sets wait for it to exit.
+            #
+            def write():
+                o.X = 3
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join(0.05)
+            self.assertTrue(thread.is_alive())
+            self.assertEquals(o.Y(), 10)
+        thread.join()
+        self.assertEquals(o.Y(), 6)
+
+    def test_setsWithinContexts(self):
+        o = self.o
+        with nodes.GraphContext():
+            o.X = 4
+            self.assertEquals(o.Y(), 8)
+        self.assertEquals(o.Y(), 8)
+
+    def test_evaluateParallel(self):
+        graph = nodes.getGraph()
+        graph.maxThreads = 4
+        positions = [Position() for i in range(4)]
+        rendezvous = Rendezvous(4)
+        rendezvous.met = []
+        for position in positions:
+            position.rendezvous = rendezvous
+        portfolio = Portfolio(Positions=positions)
+        try:
+            self.assertEquals(portfolio.Value(), 40)
+        finally:
+            graph.maxThreads = None
+
+        # Each calculation waited for all of the others, so they ran
+        # at the same time.
+        #
+        self.assertEquals(rendezvous.met, [True] * 4)
+        valueNodes = set(position.Value.node() for position in positions)
+        self.assertTrue(valueNodes <= portfolio.Value.node().inputs)
+
+        positions[2].Quantity = 3
+        self.assertFalse(portfolio.Value.node().isValid())
+        self.assertEquals(portfolio.Value(), 60)
+
+    def test_nestedEvaluateParallelRunsOnTheWorker(self):
+        graph = nodes.getGraph()
+        graph.maxThreads = 2
+        threads = set()
+        portfolios = []
+        for i in range(4):
+            positions = [Position() for j in range(3)]
+            for position in positions:
+                position.threads = threads
+            portfolios.append(Portfolio(Positions=positions))
+        try:
+            values = graph.evaluateParallel([portfolio.Value.node() for portfolio in portfolios])
+        finally:
+            graph.maxThreads = None
+        self.assertEquals(values, [30] * 4)
+        self.assertTrue(len(threads) <= 2)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_evaluateParallelWithExecutor(self):
+        positions = [Position() for i in range(3)]
+        pool = multiprocessing.pool.ThreadPool(3)
+        try:
+            values = nodes.getGraph().evaluateParallel([p.Value.node() for p in positions], executor=pool)
+        finally:
+            pool.close()
+        self.assertEquals(values, [10, 10, 10])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,5 +11,6 @@ setup(name='nodes',
       author='Adam M. Donahue',
       author_email='adam.donahue@gmail.com',
       license='BSD',
-      packages=['nodes']
+      packages=['nodes'],
+      extras_require={'numpy': ['numpy']}
       )